@@ -0,0 +1,83 @@
+# -*- coding: utf8 -*-
+"""进程内缓存和跨进程失效
+每个启用本地缓存的model一个CacheDict, 条数和存活时间有上限. 删除缓存时通过redis pub/sub
+广播key, 每个worker的订阅线程收到后把key从本进程的缓存里删掉. 订阅断开期间错过的失效
+在重新订阅时清空缓存, 订阅建立之前的失效由CacheDict的存活时间兜底.
+订阅线程需要uWSGI开启enable-threads, 没有开启时不使用本地缓存
+"""
+from .cachedict import CacheDict
+from .log import print_log
+from .util import threads_enabled
+from .xredis import Redis
+
+import os
+import threading
+import time
+import traceback
+
+CHANNEL = 'cache:invalidate'
+
+_caches = dict()
+_lock = threading.Lock()
+_listener = dict(pid=None)
+
+
+def get_cache(name, max_len, max_age):
+    """按名字取本进程的缓存, 没有则创建; 无法运行订阅线程时返回None"""
+    if not threads_enabled():
+        # 收不到失效消息, 缓存里的对象在存活时间内都可能是旧的
+        return None
+    cache = _caches.get(name)
+    if cache is None:
+        with _lock:
+            cache = _caches.get(name)
+            if cache is None:
+                cache = _caches[name] = CacheDict(max_len=max_len, max_age_seconds=max_age)
+    _ensure_listener()
+    return cache
+
+
+def evict(key):
+    """删除本进程缓存里的key"""
+    for cache in _caches.values():
+        cache.pop(key)
+
+
+def invalidate(key):
+    """删除所有进程缓存里的key"""
+    evict(key)
+    Redis.publish(CHANNEL, key)
+
+
+def _ensure_listener():
+    # uWSGI在fork之后才会用到缓存, 按pid判断本进程是否已经启动订阅线程
+    pid = os.getpid()
+    if _listener['pid'] == pid:
+        return
+    with _lock:
+        if _listener['pid'] == pid:
+            return
+        _listener['pid'] = pid
+        thread = threading.Thread(target=_listen)
+        thread.daemon = True
+        thread.start()
+
+
+def _listen():
+    while True:
+        pubsub = Redis.pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.subscribe(CHANNEL)
+            # 重新订阅前可能错过了失效消息, 清空本进程缓存
+            for cache in _caches.values():
+                with cache.lock:
+                    cache.clear()
+            for message in pubsub.listen():
+                if message['type'] == 'message':
+                    evict(message['data'])
+        except Exception:
+            # 订阅断开期间本进程的缓存可能是旧的, 记录下来便于发现
+            print_log('app', 'cache invalidation listener failed, retrying\n%s' % traceback.format_exc())
+        finally:
+            pubsub.close()
+        time.sleep(1)
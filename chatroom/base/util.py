@@ -2,13 +2,22 @@
 from datetime import datetime
 from flask import jsonify, request
 from functools import wraps
+from django.db import connection
 from . import error
+from .log import print_log
 
 import cPickle as cjson
 import functools
+import hmac
+import math
 import random
+import threading
 import time
 import hashlib
+import os
+import Queue
+import settings
+import traceback
 from .xredis import Redis
 
 
@@ -66,63 +75,308 @@ def get_md5(str):
     return mymd5.hexdigest()
 
 
+def sign_chat_token(uid, ttl=None):
+    """签发webchat身份令牌 "<uid>:<过期时间>:<签名>", 签名是HMAC-SHA256(CHAT_TOKEN_SECRET, "<uid>:<过期时间>")"""
+    ttl = settings.CHAT_TOKEN_TTL if ttl is None else ttl
+    payload = '%s:%d' % (uid, int(time.time() + ttl))
+    signature = hmac.new(settings.CHAT_TOKEN_SECRET, payload, hashlib.sha256).hexdigest()
+    return '%s:%s' % (payload, signature)
+
+
+def threads_enabled():
+    """uWSGI没有开启enable-threads时不会运行应用自己启动的线程"""
+    try:
+        import uwsgi
+    except ImportError:
+        return True
+    opt = getattr(uwsgi, 'opt', {})
+    return 'enable-threads' in opt or 'threads' in opt
+
+
 class Lockit(object):
     def __init__(self, cache, key, expire=5, mock=False):
         self._cache = cache
         self._key = key
         self._expire = expire
         self._mock = mock
+        self._acquired = False
 
     def __enter__(self):
         if self._mock:
             return False
         if self._cache.set(self._key, 1, ex=self._expire, nx=True):
+            self._acquired = True
             return False
         else:
             return True
 
     def __exit__(self, *args):
-        if not self._mock:
+        # 只释放自己拿到的锁, 等待者不能删掉别人的锁; 异常照常抛出
+        if self._acquired:
             self._cache.delete(self._key)
+        return False
+
+
+class _Flight(object):
+    """进程内同一个key正在进行的一次回源, 其他线程等它的结果"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+_flights = dict()
+_flights_lock = threading.Lock()
+# 进程内正在后台刷新的key
+_refreshing = set()
+
+# 后台刷新的线程数和排队上限, 排满时放弃这次刷新, 下次读到时再提交
+REFRESH_WORKERS = 2
+REFRESH_QUEUE_SIZE = 100
+_refresher = dict(pid=None, queue=None)
+
+
+def _refresh_worker(queue):
+    while True:
+        job = queue.get()
+        try:
+            job()
+        except Exception:
+            print_log('app', traceback.format_exc())
+        finally:
+            # 工作线程里的ORM查询会打开自己的数据库连接, 每次刷新完关闭
+            connection.close()
+
+
+def _submit_refresh(job):
+    """提交后台刷新, 返回是否已排队"""
+    if not threads_enabled():
+        # 刷新线程不会运行, 在本次调用里同步刷新; 不能关闭请求自己的数据库连接
+        try:
+            job()
+        except Exception:
+            print_log('app', traceback.format_exc())
         return True
+    pid = os.getpid()
+    if _refresher['pid'] != pid:
+        # fork之后按进程重新创建刷新线程
+        with _flights_lock:
+            if _refresher['pid'] != pid:
+                queue = Queue.Queue(maxsize=REFRESH_QUEUE_SIZE)
+                for i in range(REFRESH_WORKERS):
+                    thread = threading.Thread(target=_refresh_worker, args=(queue,))
+                    thread.daemon = True
+                    thread.start()
+                _refresher.update(pid=pid, queue=queue)
+    try:
+        _refresher['queue'].put_nowait(job)
+    except Queue.Full:
+        return False
+    return True
+
+
+def _meta_key(key):
+    return '%s:meta' % (key)
+
+
+# 集合类型每条写入命令最多带的成员数
+STORE_CHUNK = 1000
 
 
-def _cached_result(key_func, timeout=86400, snowslide=False, rtype='String'):
+def _chunk_commands(rtype, result):
+    """把结果拆成若干条有界的写入命令"""
+    if rtype == 'Hash':
+        items = result.items()
+        return [('hmset', dict(items[i:i + STORE_CHUNK])) for i in range(0, len(items), STORE_CHUNK)]
+    if rtype == 'SortedSet':
+        # score, member成对出现
+        size = STORE_CHUNK * 2
+        result = list(result)
+        return [('zadd',) + tuple(result[i:i + size]) for i in range(0, len(result), size)]
+    result = list(result)
+    command = 'rpush' if rtype == 'List' else 'sadd'
+    return [(command,) + tuple(result[i:i + STORE_CHUNK]) for i in range(0, len(result), STORE_CHUNK)]
+
+
+def _store_result(key, result, timeout, rtype, soft_timeout=None, delta=0):
+    """写入缓存, 值, 过期时间和软过期信息在一个MULTI里写入, 读者看不到写了一半的状态.
+    超过一段的集合先分段写到临时key, 再在MULTI里RENAME过去, 避免一个大事务长时间阻塞redis
+    """
+    if rtype not in ('Object', 'Hash', 'List', 'Set', 'SortedSet'):
+        return
+    if rtype in ('Object', 'Hash') and not result:
+        return
+    pipe = Redis.pipeline()
+    if rtype == 'Object':
+        pipe.setex(key, timeout, cjson.dumps(result, 2))
+    elif not result:
+        # 处理结果为空数据, 防止穿透db, 在增加和查询的时候需要判断数据结构
+        pipe.setex(key, timeout, 'empty')
+    else:
+        commands = _chunk_commands(rtype, result)
+        target = key
+        if len(commands) > 1:
+            target = '%s:tmp:%s' % (key, random.randint(0, 1 << 30))
+            fill = Redis.pipeline(transaction=False)
+            fill.delete(target)
+            for command in commands:
+                getattr(fill, command[0])(target, *command[1:])
+            fill.expire(target, timeout)
+            fill.execute()
+            pipe.rename(target, key)
+        else:
+            pipe.delete(key)
+            getattr(pipe, commands[0][0])(key, *commands[0][1:])
+        pipe.expire(key, timeout)
+    if soft_timeout:
+        # 软过期时间和回源耗时, 读取时判断是否需要刷新
+        meta_key = _meta_key(key)
+        pipe.hmset(meta_key, {'expiry': time.time() + soft_timeout, 'delta': delta})
+        pipe.expire(meta_key, timeout)
+    pipe.execute()
+
+
+def _load_result(key, rtype, with_meta=False):
+    """按func返回值的形式读出缓存, 缓存不存在返回None; with_meta时同一次往返读出软过期信息,
+    返回(结果, meta)"""
+    pipe = Redis.pipeline(transaction=False)
+    if rtype == 'Object':
+        pipe.get(key)
+    elif rtype == 'Hash':
+        pipe.hgetall(key)
+    elif rtype in ('List', 'Set', 'SortedSet'):
+        # 'empty'标记是字符串, 读集合会报WRONGTYPE, 按TYPE区分
+        pipe.type(key)
+        if rtype == 'List':
+            pipe.lrange(key, 0, -1)
+        elif rtype == 'Set':
+            pipe.smembers(key)
+        else:
+            pipe.zrange(key, 0, -1, withscores=True)
+    if with_meta:
+        pipe.hgetall(_meta_key(key))
+    results = pipe.execute(raise_on_error=False) if len(pipe) else []
+    meta = results.pop() if with_meta else None
+    if isinstance(meta, Exception):
+        meta = None
+
+    result = None
+    if rtype == 'Object':
+        result = cjson.loads(results[0]) if results[0] else None
+    elif rtype == 'Hash':
+        result = results[0] or None
+    elif rtype in ('List', 'Set', 'SortedSet'):
+        kind, value = results
+        if kind == 'string':
+            result = set() if rtype == 'Set' else []
+        elif kind != 'none' and not isinstance(value, Exception):
+            if rtype == 'SortedSet':
+                result = []
+                for member, score in value:
+                    result.extend((score, member))
+            else:
+                result = value
+    return (result, meta) if with_meta else result
+
+
+def _should_refresh(meta, beta):
+    """超过软过期时间, 或按XFetch以回源耗时为尺度随机提前刷新"""
+    if not meta:
+        return True
+    expiry = float(meta.get('expiry', 0))
+    delta = float(meta.get('delta', 0))
+    return time.time() - delta * beta * math.log(1 - random.random()) >= expiry
+
+
+def _wait_result(key, lock_key, rtype, wait):
+    """其他进程正在回源, 退避轮询锁释放后读它写好的缓存, 超时或回源失败返回None"""
+    deadline = time.time() + wait
+    delay = 0.005
+    while time.time() < deadline:
+        time.sleep(delay)
+        delay = min(delay * 2, 0.1)
+        if not Redis.exists(lock_key):
+            return _load_result(key, rtype)
+    return None
+
+
+def _cached_result(key_func, timeout=86400, snowslide=False, rtype='String', wait=2,
+                   soft_timeout=None, beta=1.0):
     """根据rtype参数选择相应的redis结构进行缓存
     rtype: String, Hash, Set, List, SortedSet
+    snowslide: 防止缓存击穿, 同一个key同时只有一个回源. 进程内的调用等同一次回源的结果,
+    其他进程拿不到锁时等待最多wait秒读取回源写好的缓存, 超时再自己回源
+    soft_timeout: 设置后先读缓存, 缓存超过soft_timeout仍然直接返回, 同时由一个worker在后台刷新,
+    timeout仍是redis里的过期时间. beta是XFetch提前刷新的系数, 按回源耗时随机提前刷新, 0为不提前
     """
     def wrapper(func):
-        @wraps(func)
-        def inner_func(*args):
-            key = key_func(*args) if callable(key_func) else key_func
+        def load(key, args):
+            start = time.time()
+            result = func(*args)
+            _store_result(key, result, timeout, rtype, soft_timeout, time.time() - start)
+            return result
+
+        def fill(key, args):
             result = None
-            mock = not snowslide
-            with Lockit(Redis, 'lock:%s' % (key), mock=mock) as locked:
+            lock_key = 'lock:%s' % (key)
+            with Lockit(Redis, lock_key, mock=not snowslide) as locked:
                 if locked:
-                    time.sleep(0.5)
-                else:
-                    result = func(*args)
-                    if rtype == 'Object' and result:
-                        Redis.setex(key, timeout, cjson.dumps(result, 2))
-                    elif rtype == 'Hash' and result:
-                        Redis.hmset(key, result)
-                        Redis.expire(key, timeout)
-                    elif rtype == 'List':
-                        Redis.delete(key)
-                        # 处理结果为空数据, 防止穿透db, 在增加和查询的时候需要判断数据结构
-                        Redis.rpush(key, *result) if result else Redis.set(key, 'empty')
-                        Redis.expire(key, timeout)
-                    elif rtype == 'Set':
-                        Redis.delete(key)
-                        # 处理结果为空数据, 防止穿透db, 在增加和查询的时候需要判断数据结构
-                        Redis.sadd(key, *result) if result else Redis.set(key, 'empty')
-                        Redis.expire(key, timeout)
-                    elif rtype == 'SortedSet':
-                        Redis.delete(key)
-                        # 处理结果为空数据, 防止穿透db, 在增加和查询的时候需要判断数据结构
-                        Redis.zadd(key, *result) if result else Redis.set(key, 'empty')
-                        Redis.expire(key, timeout)
+                    result = _wait_result(key, lock_key, rtype, wait)
+                if not locked or result is None:
+                    result = load(key, args)
             return result
+
+        def refresh(key, args):
+            with _flights_lock:
+                if key in _refreshing:
+                    return
+                _refreshing.add(key)
+
+            def run():
+                try:
+                    with Lockit(Redis, 'lock:%s' % (key)) as locked:
+                        if not locked:
+                            load(key, args)
+                finally:
+                    with _flights_lock:
+                        _refreshing.discard(key)
+            if not _submit_refresh(run):
+                with _flights_lock:
+                    _refreshing.discard(key)
+
+        @wraps(func)
+        def inner_func(*args):
+            key = key_func(*args) if callable(key_func) else key_func
+            if soft_timeout:
+                result, meta = _load_result(key, rtype, with_meta=True)
+                if result is not None:
+                    if _should_refresh(meta, beta):
+                        refresh(key, args)
+                    return result
+            if not snowslide:
+                return fill(key, args)
+            with _flights_lock:
+                flight = _flights.get(key)
+                leader = flight is None
+                if leader:
+                    flight = _flights[key] = _Flight()
+            if not leader:
+                if not flight.event.wait(wait):
+                    return fill(key, args)
+                # 回源失败时等待者拿到同一个异常, 不再各自回源
+                if flight.error is not None:
+                    raise flight.error
+                return flight.result
+            try:
+                flight.result = fill(key, args)
+            except Exception as e:
+                flight.error = e
+                raise
+            finally:
+                with _flights_lock:
+                    _flights.pop(key, None)
+                flight.event.set()
+            return flight.result
         return inner_func
     return wrapper
 
@@ -1,71 +1,142 @@
 # -*- coding: utf8 -*-
+from django.core.signals import request_finished
+from django.db import transaction
 from django_extensions.db.models import TimeStampedModel
 from chatroom.base.util import cached_object
 from chatroom.base.xredis import Redis
-from chatroom.base import const
+from chatroom.base import const, localcache
 import cPickle as cjson
+import threading
 from playhouse.shortcuts import model_to_dict, dict_to_model
 
+# 事务里修改过的对象, 请求结束(事务已提交)后再删一次缓存
+_pending = threading.local()
+
+
+def _clear_pending(sender, **kwargs):
+    pending = getattr(_pending, 'objects', None)
+    if not pending:
+        return
+    _pending.objects = None
+    for cls, oid in pending:
+        cls.clear_redis(oid)
+
+request_finished.connect(_clear_pending)
+
 
 class BaseModel(TimeStampedModel):
     """
     基类
     """
     OBJECT_KEY = '%(name)s:obj:%(oid)s'
+    OBJECT_TIMEOUT = 86400  # 对象缓存时间
+    MGET_CHUNK = 100  # get_list每条MGET的key数
 
     ENABLE_LOCAL_CACHE = False  # 启用内存缓存
+    LOCAL_CACHE_SIZE = 10000  # 每个model内存缓存的对象数
+    LOCAL_CACHE_AGE = 30  # 内存缓存最长存活秒数, 错过失效消息时的最大不一致时间
+
+    @classmethod
+    def _object_key(cls, oid):
+        return cls.OBJECT_KEY % ({'name': cls.__name__.lower(), 'oid': str(oid)})
 
     @classmethod
-    @cached_object(lambda cls, oid: cls.OBJECT_KEY % ({
-        'name': cls.__name__.lower(), 'oid': str(oid)}))
+    def _local_cache(cls):
+        """本进程内该model的缓存, 未启用返回None"""
+        if not cls.ENABLE_LOCAL_CACHE:
+            return None
+        return localcache.get_cache(cls.__name__.lower(), cls.LOCAL_CACHE_SIZE, cls.LOCAL_CACHE_AGE)
+
+    @classmethod
+    @cached_object(lambda cls, oid: cls._object_key(oid), timeout=OBJECT_TIMEOUT)
     def _load_object(cls, oid):
         obj = cls.objects.get(id=oid)
         return model_to_dict(obj)
 
+    @classmethod
+    def _load_objects(cls, oids):
+        """一次查询多个对象, 返回{oid: dict}"""
+        return dict((str(obj.id), model_to_dict(obj)) for obj in cls.objects.filter(id__in=oids))
+
     @classmethod
     def get_one(cls, oid, check_online=True):
         obj = None
         if not oid:
             return obj
 
-        key = cls.OBJECT_KEY % ({'name': cls.__name__.lower(), 'oid': str(oid)})
+        key = cls._object_key(oid)
         # 先从本地内存中获取
-        if cls.ENABLE_LOCAL_CACHE and hasattr(cls, 'CACHED_OBJS'):
-            obj = cls.CACHED_OBJS.get(key)
+        cache = cls._local_cache()
+        if cache is not None:
+            obj = cache.get(key)
 
         # 从缓存中获取
         if not obj:
             obj = Redis.get(key)
-            obj = cls(cjson.loads(obj)) if obj else cls._load_object(oid)
+            try:
+                obj = cjson.loads(obj) if obj else cls._load_object(oid)
+            except cls.DoesNotExist:
+                return None
             # 存入本地内存
-            if cls.ENABLE_LOCAL_CACHE and hasattr(cls, 'CACHED_OBJS') and obj:
-                cls.CACHED_OBJS[key] = obj
+            if cache is not None and obj:
+                cache[key] = obj
 
-        if not obj or (check_online and obj.offline):
+        if not obj:
             return None
         obj = dict_to_model(cls, obj)
+        if check_online and obj.offline:
+            return None
         return obj
 
     @classmethod
     def get_list(cls, ids, check_online=True):
+        """批量获取, 依次查本地内存, 分段MGET缓存, 未命中的用一次id__in查询并一次写回缓存"""
         if not ids:
             return []
-        ret = list()
+        oids = [str(_id) for _id in ids if _id]
+        cache = cls._local_cache()
+        found = dict()
+        if cache is not None:
+            for oid in oids:
+                obj = cache.get(cls._object_key(oid))
+                if obj:
+                    found[oid] = obj
+
         # 使用mget方式一次性从缓存获取
-        # keys = []
-        # for _id in ids:
-        #     key = cls.OBJECT_KEY % ({'name': cls.__name__.lower(), 'oid': str(_id)})
-        #     keys.append(key)
-
-        # objs = Redis.mget(keys)
-        # for obj in objs:
-        #     obj = cls(cjson.loads(obj)) if obj else cls.get_one(_id, check_online=check_online)
-        #     if obj and not obj.offline:
-        #         ret.append(obj)
-        for _id in ids:
-            obj = cls.get_one(_id, check_online=check_online)
-            if obj:
-                ret.append(obj)
+        missing = [oid for oid in set(oids) if oid not in found]
+        if missing:
+            pipe = Redis.pipeline(transaction=False)
+            for i in range(0, len(missing), cls.MGET_CHUNK):
+                pipe.mget([cls._object_key(oid) for oid in missing[i:i + cls.MGET_CHUNK]])
+            values = [value for chunk in pipe.execute() for value in chunk]
+            loaded = dict()
+            for oid, value in zip(missing, values):
+                if value:
+                    loaded[oid] = cjson.loads(value)
+
+            missing = [oid for oid in missing if oid not in loaded]
+            if missing:
+                objs = cls._load_objects(missing)
+                pipe = Redis.pipeline(transaction=False)
+                for oid, obj in objs.items():
+                    pipe.setex(cls._object_key(oid), cls.OBJECT_TIMEOUT, cjson.dumps(obj, 2))
+                pipe.execute()
+                loaded.update(objs)
+
+            found.update(loaded)
+            if cache is not None:
+                for oid, obj in loaded.items():
+                    cache[cls._object_key(oid)] = obj
+
+        ret = list()
+        for oid in oids:
+            obj = found.get(oid)
+            if not obj:
+                continue
+            obj = dict_to_model(cls, obj)
+            if check_online and obj.offline:
+                continue
+            ret.append(obj)
         return ret
 
     @classmethod
@@ -89,16 +160,27 @@ class BaseModel(TimeStampedModel):
 
     @classmethod
     def clear_redis(cls, oid):
-        key = cls.OBJECT_KEY % ({'name': cls.__class__.__name__.lower(), 'oid': str(oid)})
-        return Redis.delete(key)
+        key = cls._object_key(oid)
+        ret = Redis.delete(key)
+        if cls.ENABLE_LOCAL_CACHE:
+            # 通知所有worker删掉内存里的对象
+            localcache.invalidate(key)
+        return ret
 
     @property
     def offline(self):
         return self.status is None or self.status == const.OFFLINE
 
     def save(self, **kwargs):
-        self.clear_redis(self.id)
+        # 写入之后再删缓存, 否则其他worker收到失效后可能把旧行重新读进缓存;
+        # ATOMIC_REQUESTS下提交前仍可能读到旧行, 提交后再删一次
         super(BaseModel, self).save(**kwargs)
+        self.clear_redis(self.id)
+        if transaction.get_connection(kwargs.get('using')).in_atomic_block:
+            pending = getattr(_pending, 'objects', None)
+            if pending is None:
+                pending = _pending.objects = set()
+            pending.add((type(self), self.id))
 
     class Meta:
         abstract = True
@@ -3,6 +3,7 @@ from django.db import models
 from django.contrib.auth.models import User as OldUser
 from playhouse.shortcuts import model_to_dict
 from chatroom.base.util import cached_object
+from chatroom.base.xredis import Redis
 from chatroom.base import const
 from chatroom.models.base import BaseModel
 
@@ -37,12 +38,16 @@ class UserProfile(BaseModel):
         return self.nickname
 
     @classmethod
-    @cached_object(lambda cls, oid: cls.OBJECT_KEY % ({
-        'name': cls.__name__.lower(), 'oid': str(oid)}))
+    @cached_object(lambda cls, oid: cls._object_key(oid), timeout=BaseModel.OBJECT_TIMEOUT)
     def _load_object(cls, oid):
         obj = cls.objects.get(user__id=oid)
         return model_to_dict(obj)
 
+    @classmethod
+    def _load_objects(cls, oids):
+        return dict((str(obj.user_id), model_to_dict(obj))
+                    for obj in cls.objects.filter(user__id__in=oids))
+
 
 class Usership(BaseModel):
     UserShipStatus = (
@@ -58,6 +63,8 @@ class Usership(BaseModel):
     note = models.CharField(max_length=200, blank=True, null=True)
     status = models.IntegerField(choices=UserShipStatus)
 
+    FRIENDS_KEY = 'friends:%s'  # 好友uid集合, webchat据此校验私信
+
     class Meta:
         db_table = "usership"
         app_label = "chatroom"
@@ -65,3 +72,29 @@ class Usership(BaseModel):
 
     def __unicode__(self):
         return self.note
+
+    @classmethod
+    def cache_friends(cls, uid):
+        """按数据库重建用户的好友集合"""
+        ships = cls.objects.filter(status=const.AGREE).select_related('Owner')
+        friends = [ship.Feedback_id for ship in ships.filter(Owner__user__id=uid)]
+        friends += [ship.Owner.user_id for ship in ships.filter(Feedback__id=uid)]
+        key = cls.FRIENDS_KEY % uid
+        pipe = Redis.pipeline()
+        pipe.delete(key)
+        if friends:
+            pipe.sadd(key, *friends)
+        pipe.execute()
+        return friends
+
+    def save(self, **kwargs):
+        super(Usership, self).save(**kwargs)
+        owner = self.Owner.user_id
+        pipe = Redis.pipeline()
+        if self.status == const.AGREE:
+            pipe.sadd(self.FRIENDS_KEY % owner, self.Feedback_id)
+            pipe.sadd(self.FRIENDS_KEY % self.Feedback_id, owner)
+        else:
+            pipe.srem(self.FRIENDS_KEY % owner, self.Feedback_id)
+            pipe.srem(self.FRIENDS_KEY % self.Feedback_id, owner)
+        pipe.execute()
@@ -0,0 +1,254 @@
+# -*- coding: utf8 -*-
+from chatroom.base import localcache, util
+from chatroom.base.xredis import Redis
+from chatroom.base.util import cached_object, cached_hash, cached_set, cached_list, cached_zset
+
+import threading
+import time
+import unittest
+
+
+def run_threads(func, count=10):
+    """count个线程同时调用func, 返回(结果, 异常)"""
+    results = []
+    errors = []
+
+    def run():
+        try:
+            results.append(func())
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=run) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, errors
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    """
+    防击穿: 同一个key同时只有一次回源
+    """
+    KEY = 'test:flight'
+
+    def setUp(self):
+        Redis.delete(self.KEY, 'lock:%s' % (self.KEY))
+
+    def test_single_flight(self):
+        calls = []
+
+        @cached_object(self.KEY, snowslide=True)
+        def load():
+            calls.append(1)
+            time.sleep(0.2)
+            return {'count': len(calls)}
+
+        results, errors = run_threads(load)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(errors, [])
+        self.assertEqual(results, [{'count': 1}] * 10)
+        self.assertFalse(Redis.exists('lock:%s' % (self.KEY)))
+
+    def test_single_flight_error(self):
+        calls = []
+
+        @cached_object(self.KEY, snowslide=True)
+        def load():
+            calls.append(1)
+            time.sleep(0.2)
+            raise ValueError('db down')
+
+        # 回源失败时等待者拿到同一个异常, 不再各自回源, 锁也要释放
+        results, errors = run_threads(load)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [])
+        self.assertEqual(len(errors), 10)
+        self.assertTrue(all(isinstance(e, ValueError) for e in errors))
+        self.assertFalse(Redis.exists(self.KEY))
+        self.assertFalse(Redis.exists('lock:%s' % (self.KEY)))
+
+
+class SoftTimeoutTestCase(unittest.TestCase):
+    """
+    软过期: 先返回旧值, 由后台刷新
+    """
+    KEY = 'test:soft'
+
+    def setUp(self):
+        Redis.delete(self.KEY, util._meta_key(self.KEY), 'lock:%s' % (self.KEY))
+        self.calls = []
+        self.threads_enabled = util.threads_enabled
+
+    def tearDown(self):
+        util.threads_enabled = self.threads_enabled
+
+    def loader(self):
+        @cached_object(self.KEY, soft_timeout=60, beta=0)
+        def load():
+            self.calls.append(1)
+            count = len(self.calls)
+            if count > 1:
+                # 刷新回源较慢, 期间的读取都拿到旧值
+                time.sleep(0.2)
+            return {'count': count}
+        return load
+
+    def expire(self):
+        Redis.hset(util._meta_key(self.KEY), 'expiry', 0)
+
+    def wait_refreshed(self, timeout=2):
+        deadline = time.time() + timeout
+        while (not self.calls or util._refreshing) and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_fresh(self):
+        load = self.loader()
+        self.assertEqual(load(), {'count': 1})
+        self.assertEqual(load(), {'count': 1})
+        self.assertEqual(len(self.calls), 1)
+        self.assertTrue(float(Redis.hget(util._meta_key(self.KEY), 'expiry')) > time.time())
+
+    def test_stale_while_revalidate(self):
+        load = self.loader()
+        load()
+        self.expire()
+        # 超过软过期时间仍返回旧值, 后台只刷新一次
+        results, errors = run_threads(load)
+        self.assertEqual(results, [{'count': 1}] * 10)
+        self.wait_refreshed()
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(load(), {'count': 2})
+
+    def test_refresh_without_threads(self):
+        # uWSGI没有开启线程时在调用里同步刷新, 不会一直留在_refreshing里
+        util.threads_enabled = lambda: False
+        load = self.loader()
+        load()
+        self.expire()
+        self.assertEqual(load(), {'count': 1})
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(util._refreshing, set())
+        self.assertEqual(load(), {'count': 2})
+
+    def test_should_refresh(self):
+        now = time.time()
+        self.assertTrue(util._should_refresh(None, 1.0))
+        self.assertFalse(util._should_refresh({'expiry': now + 60, 'delta': 0}, 1.0))
+        self.assertTrue(util._should_refresh({'expiry': now - 1, 'delta': 0}, 1.0))
+        # 回源耗时相对剩余时间很长时按XFetch提前刷新
+        self.assertTrue(util._should_refresh({'expiry': now + 1, 'delta': 1000}, 1.0))
+        self.assertFalse(util._should_refresh({'expiry': now + 1, 'delta': 1000}, 0))
+
+
+class ChunkedStoreTestCase(unittest.TestCase):
+    """
+    大集合分段写入
+    """
+    HASH_KEY = 'test:chunk:hash'
+    SET_KEY = 'test:chunk:set'
+    LIST_KEY = 'test:chunk:list'
+    ZSET_KEY = 'test:chunk:zset'
+
+    def setUp(self):
+        self.chunk = util.STORE_CHUNK
+        util.STORE_CHUNK = 3
+        Redis.delete(self.HASH_KEY, self.SET_KEY, self.LIST_KEY, self.ZSET_KEY)
+
+    def tearDown(self):
+        util.STORE_CHUNK = self.chunk
+
+    @cached_hash(HASH_KEY)
+    def _cached_hash(self, d):
+        return d
+
+    @cached_set(SET_KEY)
+    def _cached_set(self, s):
+        return s
+
+    @cached_list(LIST_KEY)
+    def _cached_list(self, l):
+        return l
+
+    @cached_zset(ZSET_KEY)
+    def _cached_zset(self, zs):
+        return zs
+
+    def assertStored(self, key):
+        self.assertTrue(Redis.ttl(key) > 0)
+        self.assertEqual(Redis.keys('%s:tmp:*' % (key)), [])
+
+    def test_chunk_commands(self):
+        commands = util._chunk_commands('List', list('abcdefg'))
+        self.assertEqual(commands, [('rpush', 'a', 'b', 'c'), ('rpush', 'd', 'e', 'f'), ('rpush', 'g')])
+        commands = util._chunk_commands('SortedSet', [1, 'a', 2, 'b', 3, 'c', 4, 'd'])
+        self.assertEqual(commands, [('zadd', 1, 'a', 2, 'b', 3, 'c'), ('zadd', 4, 'd')])
+        commands = util._chunk_commands('Hash', dict((c, i) for i, c in enumerate('abcd')))
+        self.assertEqual([len(command[1]) for command in commands], [3, 1])
+
+    def test_cached_hash(self):
+        d = dict((c, str(i)) for i, c in enumerate('abcdefg'))
+        self.assertEqual(self._cached_hash(d), d)
+        self.assertEqual(Redis.hgetall(self.HASH_KEY), d)
+        self.assertStored(self.HASH_KEY)
+
+    def test_cached_set(self):
+        s = set('abcdefg')
+        self._cached_set(s)
+        self.assertEqual(Redis.smembers(self.SET_KEY), s)
+        self.assertStored(self.SET_KEY)
+
+    def test_cached_list(self):
+        Redis.rpush(self.LIST_KEY, 'old')
+        l = list('abcdefg')
+        self._cached_list(l)
+        # 旧的值被整个替换
+        self.assertEqual(Redis.lrange(self.LIST_KEY, 0, -1), l)
+        self.assertStored(self.LIST_KEY)
+        self._cached_list(['other'])
+        self.assertEqual(Redis.lrange(self.LIST_KEY, 0, -1), ['other'])
+
+    def test_cached_zset(self):
+        zs = []
+        for i, c in enumerate('abcdefg'):
+            zs.extend((i, c))
+        self._cached_zset(zs)
+        self.assertEqual(Redis.zrange(self.ZSET_KEY, 0, -1), list('abcdefg'))
+        self.assertStored(self.ZSET_KEY)
+        # 读出时按score, member成对返回
+        self.assertEqual(util._load_result(self.ZSET_KEY, 'SortedSet'),
+                         [float(x) if i % 2 == 0 else x for i, x in enumerate(zs)])
+
+
+class LocalCacheTestCase(unittest.TestCase):
+    """
+    进程内缓存和跨进程失效
+    """
+
+    def setUp(self):
+        self.threads_enabled = localcache.threads_enabled
+
+    def tearDown(self):
+        localcache.threads_enabled = self.threads_enabled
+
+    def wait(self, condition, timeout=2):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        return condition()
+
+    def test_invalidate(self):
+        cache = localcache.get_cache('test', 10, 30)
+        # 订阅建立时会清空缓存, 等订阅好再写入
+        self.assertTrue(self.wait(
+            lambda: Redis.execute_command('PUBSUB', 'NUMSUB', localcache.CHANNEL)[1] > 0))
+        time.sleep(0.05)
+        cache['test:local'] = {'id': 1}
+        # 其他进程发出的失效消息
+        Redis.publish(localcache.CHANNEL, 'test:local')
+        self.assertTrue(self.wait(lambda: cache.get('test:local') is None))
+
+    def test_without_threads(self):
+        # uWSGI没有开启线程时收不到失效消息, 不使用本地缓存
+        localcache.threads_enabled = lambda: False
+        self.assertIsNone(localcache.get_cache('test:nothreads', 10, 30))
@@ -0,0 +1,109 @@
+# -*- coding: utf8 -*-
+from django.contrib.auth.models import User as OldUser
+from django.core.signals import request_finished
+from django.test import TestCase
+from chatroom.base import const, localcache
+from chatroom.base.xredis import Redis
+from chatroom.models.user import UserProfile
+
+import cPickle as cjson
+
+
+class GetListTestCase(TestCase):
+    """
+    批量获取: 本地内存, 分段MGET, 未命中的一次查询
+    """
+
+    def setUp(self):
+        self.loaded = []
+        self.rows = dict()
+        for oid in ('1', '2', '3', '4'):
+            self.rows[oid] = {'id': int(oid), 'nickname': 'user%s' % oid, 'status': const.REGISTERSUCCESS}
+        self.rows['4']['status'] = const.OFFLINE
+        for oid in self.rows:
+            key = UserProfile._object_key(oid)
+            Redis.delete(key)
+            localcache.evict(key)
+
+        test = self
+
+        def load_objects(cls, oids):
+            test.loaded.append(sorted(oids))
+            return dict((oid, test.rows[oid]) for oid in oids if oid in test.rows)
+        self.load_objects = UserProfile.__dict__['_load_objects']
+        UserProfile._load_objects = classmethod(load_objects)
+        self.chunk = UserProfile.MGET_CHUNK
+
+    def tearDown(self):
+        UserProfile._load_objects = self.load_objects
+        UserProfile.MGET_CHUNK = self.chunk
+
+    def cache(self, oid):
+        Redis.setex(UserProfile._object_key(oid), 60, cjson.dumps(self.rows[oid], 2))
+
+    def nicknames(self, objs):
+        return [obj.nickname for obj in objs]
+
+    def test_order(self):
+        self.cache('1')
+        self.cache('2')
+        # 按传入的顺序返回, 重复的id各返回一次, 未命中的只查一次
+        objs = UserProfile.get_list([3, 1, 2, 1])
+        self.assertEqual(self.nicknames(objs), ['user3', 'user1', 'user2', 'user1'])
+        self.assertEqual(self.loaded, [['3']])
+        # 查到的写回缓存
+        self.assertTrue(Redis.ttl(UserProfile._object_key('3')) > 0)
+
+    def test_chunked_mget(self):
+        UserProfile.MGET_CHUNK = 1
+        for oid in ('1', '2', '3'):
+            self.cache(oid)
+        objs = UserProfile.get_list(['2', '3', '1'])
+        self.assertEqual(self.nicknames(objs), ['user2', 'user3', 'user1'])
+        self.assertEqual(self.loaded, [])
+
+    def test_missing(self):
+        objs = UserProfile.get_list([None, 5, 1, 0])
+        self.assertEqual(self.nicknames(objs), ['user1'])
+        self.assertEqual(UserProfile.get_list([]), [])
+
+    def test_check_online(self):
+        self.cache('4')
+        self.assertEqual(self.nicknames(UserProfile.get_list([4, 1])), ['user1'])
+        self.assertEqual(self.nicknames(UserProfile.get_list([4, 1], check_online=False)),
+                         ['user4', 'user1'])
+
+    def test_local_cache(self):
+        UserProfile.get_list([1, 2])
+        # 第二次从本地内存读到, 不再查询
+        Redis.delete(UserProfile._object_key('1'), UserProfile._object_key('2'))
+        objs = UserProfile.get_list([2, 1])
+        self.assertEqual(self.nicknames(objs), ['user2', 'user1'])
+        self.assertEqual(self.loaded, [['1', '2']])
+
+
+class SaveTestCase(TestCase):
+    """
+    保存后删除缓存, 事务提交后再删一次
+    """
+
+    def setUp(self):
+        user = OldUser.objects.create(username='save')
+        self.profile = UserProfile.objects.create(user=user, nickname='before')
+        self.key = UserProfile._object_key(self.profile.id)
+
+    def test_clear_after_save(self):
+        Redis.setex(self.key, 60, 'stale')
+        self.profile.nickname = 'after'
+        self.profile.save()
+        self.assertFalse(Redis.exists(self.key))
+
+    def test_clear_after_request(self):
+        self.profile.save()
+        # 提交前其他worker读到旧行放回了缓存
+        Redis.setex(self.key, 60, 'stale')
+        cache = UserProfile._local_cache()
+        cache[self.key] = {'id': self.profile.id, 'nickname': 'before'}
+        request_finished.send(sender=self.__class__)
+        self.assertFalse(Redis.exists(self.key))
+        self.assertIsNone(cache.get(self.key))
@@ -0,0 +1,757 @@
+# -*- coding: utf8 -*-
+"""webchat服务测试, 大部分使用内存代理DELIVERY_BACKEND='memory', 不需要redis;
+stream投递的测试需要本机redis"""
+from tornado import gen
+from tornado.httpclient import HTTPRequest
+from tornado.testing import AsyncHTTPTestCase, AsyncTestCase, gen_test
+from tornado.websocket import websocket_connect
+
+import json
+import os
+import redis
+import sys
+import time
+import unittest
+import urllib
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../services'))
+import webchat  # noqa
+
+SECRET = 'test-secret'
+
+
+class WebchatTestCase(AsyncHTTPTestCase):
+    """
+    启动一个内存代理的webchat, 用websocket客户端测试
+    """
+    CONFIG = dict(
+        DELIVERY_BACKEND='memory',
+        CHAT_TOKEN_SECRET=SECRET,
+        DIRECT_REQUIRE_FRIENDS=False,
+        HISTORY_SIZE=5,
+        REPLAY_SIZE=20,
+        RATE_CONN_RATE=0,
+        RATE_ROOM_RATE=0,
+        RATE_USER_RATE=0,
+    )
+
+    def get_app(self):
+        return webchat.init_app(dict(self.CONFIG))
+
+    def tearDown(self):
+        settings = self._app.settings
+        for name in ('hub', 'publisher', 'heartbeat', 'limiter', 'presence', 'watchdog'):
+            settings[name].stop()
+        super(WebchatTestCase, self).tearDown()
+
+    @gen.coroutine
+    def connect(self, room, uid=None, **params):
+        if uid is not None:
+            params['token'] = webchat.sign_token(uid, SECRET)
+        url = 'ws://127.0.0.1:%d/pigroom/ws/%s' % (self.get_http_port(), room)
+        if params:
+            url += '?' + urllib.urlencode(params)
+        conn = yield websocket_connect(url)
+        raise gen.Return(conn)
+
+    @gen.coroutine
+    def read(self, conn, count=1):
+        messages = []
+        for i in range(count):
+            message = yield conn.read_message()
+            messages.append(json.loads(message))
+        raise gen.Return(messages)
+
+    @gen.coroutine
+    def say(self, conn, count):
+        """发送count条消息并读回自己的消息"""
+        for i in range(count):
+            conn.write_message('hello%d' % i)
+        messages = yield self.read(conn, count)
+        raise gen.Return(messages)
+
+
+class RoomTestCase(WebchatTestCase):
+    """
+    房间加入, 历史回放和断线续传
+    """
+
+    @gen_test
+    def test_join_replay(self):
+        first = yield self.connect(1)
+        messages = yield self.say(first, 3)
+        self.assertEqual([d['seq'] for d in messages], [1, 2, 3])
+
+        # 后加入的连接先收到历史记录, 再收到实时消息
+        second = yield self.connect(1)
+        messages = yield self.read(second, 3)
+        self.assertEqual([d['seq'] for d in messages], [1, 2, 3])
+        self.assertEqual([d['data'] for d in messages], ['hello0', 'hello1', 'hello2'])
+        notice = yield self.read(second)
+        self.assertEqual(notice[0]['data'], 'another one come in!!!')
+        notice = yield self.read(first)
+        self.assertEqual(notice[0]['data'], 'another one come in!!!')
+
+        second.write_message('again')
+        for conn in (first, second):
+            messages = yield self.read(conn)
+            self.assertEqual((messages[0]['seq'], messages[0]['data']), (4, 'again'))
+
+    @gen_test
+    def test_resume(self):
+        first = yield self.connect(2)
+        yield self.say(first, 3)
+
+        # 只补发since之后的消息
+        second = yield self.connect(2, since=1)
+        messages = yield self.read(second, 2)
+        self.assertEqual([d['seq'] for d in messages], [2, 3])
+
+    @gen_test
+    def test_resume_reset(self):
+        first = yield self.connect(3)
+        yield self.say(first, 8)
+
+        # 缺口超出保留的历史时先通知客户端重新拉取, 再补发保留的部分
+        second = yield self.connect(3, since=1)
+        messages = yield self.read(second, 6)
+        self.assertEqual(messages[0], dict(type='state', data='reset', seq=8))
+        self.assertEqual([d['seq'] for d in messages[1:]], [4, 5, 6, 7, 8])
+
+
+class DirectTestCase(WebchatTestCase):
+    """
+    私信和离线私信
+    """
+
+    @gen_test
+    def test_direct_backlog(self):
+        sender = yield self.connect(4, uid=1)
+        sender.write_message(json.dumps(dict(type='direct', to=2, data='offline')))
+        yield gen.sleep(0.05)
+        direct = self._app.settings['hub'].direct
+        self.assertEqual(direct.stats()['backlogged'], 1)
+
+        # 接收者连接时收到离线私信
+        receiver = yield self.connect(5, uid=2)
+        messages = yield self.read(receiver)
+        self.assertEqual(messages[0]['type'], 'direct')
+        self.assertEqual((messages[0]['from'], messages[0]['to']), ('1', '2'))
+        self.assertEqual(messages[0]['data'], 'offline')
+
+        # 在线时直接投递
+        sender.write_message(json.dumps(dict(type='direct', to=2, data='online')))
+        messages = yield self.read(receiver)
+        self.assertEqual(messages[0]['data'], 'online')
+        self.assertEqual(direct.stats()['delivered'], 1)
+
+    @gen_test
+    def test_direct_anonymous(self):
+        conn = yield self.connect(6, uid='forged')
+        conn.write_message(json.dumps(dict(type='direct', to=2, data='hi')))
+        messages = yield self.read(conn)
+        self.assertEqual(messages[0], dict(type='error', data='invalid direct message'))
+
+
+class DirectFriendsTestCase(WebchatTestCase):
+    """
+    内存代理无法校验好友关系, 要求好友时私信一律拒绝
+    """
+    CONFIG = dict(WebchatTestCase.CONFIG, DIRECT_REQUIRE_FRIENDS=True)
+
+    @gen_test
+    def test_direct_rejected(self):
+        conn = yield self.connect(7, uid=1)
+        conn.write_message(json.dumps(dict(type='direct', to=2, data='hi')))
+        messages = yield self.read(conn)
+        self.assertEqual(messages[0], dict(type='error', data='not friends'))
+        self.assertEqual(self._app.settings['hub'].direct.stats()['rejected'], 1)
+
+
+class FakePresence(object):
+    """记录立即登记(取离线私信)的用户"""
+
+    def __init__(self):
+        self.registered = set()
+        self.calls = []
+
+    def register(self, uid, callback):
+        self.registered.add(uid)
+        self.calls.append(uid)
+
+
+class DirectRegisterTestCase(unittest.TestCase):
+    """
+    每个用户在本节点上的第一个连接取一次离线私信
+    """
+
+    def test_register_on_reconnect(self):
+        presence = FakePresence()
+        direct = webchat.DirectRouter(None, None, presence)
+        first = type('Handler', (object,), dict(uid='1'))()
+        direct.connect(first)
+        direct.connect(type('Handler', (object,), dict(uid='1'))())
+        self.assertEqual(presence.calls, ['1'])
+
+        # 断开后在下次flush之前重连, registered里还有该用户, 仍要取离线私信
+        for handler in list(direct.users['1']):
+            direct.disconnect(handler)
+        self.assertIn('1', presence.registered)
+        direct.connect(first)
+        self.assertEqual(presence.calls, ['1', '1'])
+
+
+class PresenceTestCase(WebchatTestCase):
+    """
+    内存代理下只统计本节点的在线状态
+    """
+
+    @gen.coroutine
+    def query(self, path):
+        response = yield self.http_client.fetch(self.get_url('/pigroom/presence/' + path))
+        raise gen.Return(json.loads(response.body))
+
+    @gen_test
+    def test_local_presence(self):
+        first = yield self.connect(8, uid=1)
+        yield self.connect(8, uid=2)
+        yield self.connect(9, uid=2)
+        yield gen.sleep(0.05)
+        counts = yield self.query('rooms?ids=8,9,10')
+        self.assertEqual(counts, {'8': 2, '9': 1, '10': 0})
+        flags = yield self.query('users?ids=1,2,3')
+        self.assertEqual(flags, {'1': True, '2': True, '3': False})
+        members = yield self.query('members?room=8')
+        self.assertEqual(members, dict(room='8', members=['1', '2']))
+
+        first.close()
+        yield gen.sleep(0.05)
+        flags = yield self.query('users?ids=1')
+        self.assertEqual(flags, {'1': False})
+        self.assertEqual(self._app.settings['presence'].stats()['pending'], 0)
+
+    def test_no_pending_changes(self):
+        # 没有flush, 进出不能留下待写入的变化
+        presence = webchat.Presence(None, None, local=True)
+        for i in range(1000):
+            presence.join('room:1', str(i))
+            presence.leave('room:1', str(i))
+        stats = presence.stats()
+        self.assertEqual((stats['users'], stats['members'], stats['pending']), (0, 0, 0))
+
+
+class CodecTestCase(unittest.TestCase):
+    """
+    紧凑消息格式
+    """
+
+    def test_compact(self):
+        body = webchat.encode_message(dict(type='message', data=u'你好', seq=12, ts=1.5))
+        self.assertEqual(body[:webchat.HEADER_SIZE], 'M%012d%016d' % (12, 1500000))
+        self.assertEqual(webchat.message_header(body), ('M', 12, 1.5))
+        self.assertEqual(webchat.decode_message(body), dict(type='message', data=u'你好', seq=12, ts=1.5))
+
+    def test_json_kind(self):
+        # 带有其他字段的消息头部后面是完整的json
+        d = {'type': 'direct', 'data': 'hi', 'from': '1', 'to': '2'}
+        body = webchat.encode_message(d)
+        self.assertEqual(body[:1], webchat.JSON_KIND)
+        self.assertEqual(webchat.decode_message(body), d)
+
+    def test_legacy_json(self):
+        body = json.dumps(dict(type='message', data='hi', seq=3))
+        self.assertEqual(webchat.message_header(body), ('M', 3, 0))
+        self.assertEqual(webchat.decode_message(body), dict(type='message', data='hi', seq=3))
+        self.assertEqual(webchat.decode_message('x' * 40), dict())
+
+    def test_wire_frame(self):
+        body = webchat.encode_message(dict(type='message', data='hi', seq=1))
+        # pigroom.bin客户端直接收紧凑格式, 其他客户端收json
+        frame, payload = webchat.wire_frame(body, binary=True)
+        self.assertEqual((frame[:1], payload), ('\x82', body))
+        frame, payload = webchat.wire_frame(body)
+        self.assertEqual(frame[:1], '\x81')
+        self.assertEqual(json.loads(payload), dict(type='message', data='hi', seq=1))
+
+
+class DeflaterTestCase(unittest.TestCase):
+    """
+    permessage-deflate的参数协商和压缩
+    """
+
+    def test_accepts(self):
+        deflater = webchat.Deflater(window_bits=12)
+        self.assertTrue(deflater.accepts({}))
+        self.assertTrue(deflater.accepts({'server_max_window_bits': '12'}))
+        self.assertTrue(deflater.accepts({'server_max_window_bits': '15'}))
+        # 共用的压缩结果不能按连接缩小窗口
+        self.assertFalse(deflater.accepts({'server_max_window_bits': '9'}))
+        self.assertFalse(deflater.accepts({'server_max_window_bits': None}))
+
+    def test_negotiate(self):
+        agreed = {}
+        webchat.Deflater(window_bits=12, client_no_context=True).negotiate(agreed)
+        self.assertEqual(agreed, {'server_no_context_takeover': None, 'server_max_window_bits': '12',
+                                  'client_no_context_takeover': None})
+
+    def test_compress(self):
+        deflater = webchat.Deflater(window_bits=10, min_size=100)
+        data = 'hello ' * 100
+        compressed = deflater.compress(data)
+        self.assertEqual(zlib.decompressobj(-10).decompress(compressed + '\x00\x00\xff\xff'), data)
+        self.assertEqual(deflater.stats()['bytes_out'], len(compressed))
+
+    def test_min_size(self):
+        deflater = webchat.Deflater(min_size=100)
+        body = webchat.encode_message(dict(type='message', data='hi'))
+        frame, payload = webchat.wire_frame(body, deflater=deflater)
+        self.assertEqual(frame[:1], '\x81')
+        body = webchat.encode_message(dict(type='message', data='hi' * 100))
+        frame, payload = webchat.wire_frame(body, deflater=deflater)
+        # 压缩过的帧置RSV1位
+        self.assertEqual(frame[:1], '\xc1')
+
+
+class CompressionTestCase(WebchatTestCase):
+    """
+    握手时协商压缩
+    """
+    CONFIG = dict(WebchatTestCase.CONFIG, COMPRESSION=True, COMPRESS_MIN_SIZE=100,
+                  COMPRESS_WINDOW_BITS=12)
+
+    def url(self, room):
+        return 'ws://127.0.0.1:%d/pigroom/ws/%s' % (self.get_http_port(), room)
+
+    @gen_test
+    def test_compressed_message(self):
+        conn = yield websocket_connect(self.url(11), compression_options={})
+        self.assertIn('server_no_context_takeover', conn.headers['Sec-WebSocket-Extensions'])
+        self.assertIn('server_max_window_bits=12', conn.headers['Sec-WebSocket-Extensions'])
+        conn.write_message('hi' * 100)
+        messages = yield self.read(conn)
+        self.assertEqual(messages[0]['data'], 'hi' * 100)
+        response = yield self.http_client.fetch(self.get_url('/pigroom/metrics?rooms=0'))
+        self.assertEqual(json.loads(response.body)['compression']['messages'], 1)
+
+    @gen_test
+    def test_declined_offer(self):
+        # 客户端要求更小的服务端窗口时不启用压缩, 连接仍然可用
+        request = HTTPRequest(self.url(12), headers={
+            'Sec-WebSocket-Extensions': 'permessage-deflate; server_max_window_bits=9'})
+        conn = yield websocket_connect(request)
+        self.assertNotIn('Sec-WebSocket-Extensions', conn.headers)
+        conn.write_message('hi' * 100)
+        messages = yield self.read(conn)
+        self.assertEqual(messages[0]['data'], 'hi' * 100)
+
+
+class RedisTestCase(WebchatTestCase):
+    """
+    使用本机redis, 每个用例前清掉ROOMS里各房间的key
+    """
+    ROOMS = ()
+
+    def setUp(self):
+        self.redis = redis.StrictRedis(self.CONFIG['REDIS_HOST'], self.CONFIG['REDIS_PORT'])
+        for room in self.ROOMS:
+            keys = self.redis.keys('room:%s:*' % room)
+            if keys:
+                self.redis.delete(*keys)
+        super(RedisTestCase, self).setUp()
+
+    @gen.coroutine
+    def wait_for(self, condition, timeout=2):
+        deadline = time.time() + timeout
+        while not condition():
+            self.assertTrue(time.time() < deadline)
+            yield gen.sleep(0.01)
+
+    @gen.coroutine
+    def read_messages(self, conn, count):
+        """读取count条带seq的聊天消息, 跳过进房间通知"""
+        messages = []
+        while len(messages) < count:
+            d = yield self.read(conn)
+            if 'seq' in d[0]:
+                messages.append(d[0])
+        raise gen.Return(messages)
+
+
+class StreamTestCase(RedisTestCase):
+    """
+    redis stream投递
+    """
+    CONFIG = dict(
+        WebchatTestCase.CONFIG,
+        DELIVERY_BACKEND='stream',
+        REDIS_HOST='localhost',
+        REDIS_PORT=6379,
+        ROOM_REGISTRY_TTL=0,
+        REPLAY_SIZE=0,
+    )
+    ROOMS = (101, 102)
+
+    @gen_test
+    def test_stream_delivery(self):
+        first = yield self.connect(101)
+        second = yield self.connect(101)
+        backend = self._app.settings['hub'].backend
+        yield self.wait_for(lambda: 'room:101:stream' in backend.cursors)
+        for i in range(3):
+            first.write_message('hello%d' % i)
+        for conn in (first, second):
+            messages = yield self.read_messages(conn, 3)
+            self.assertEqual([(d['seq'], d['data']) for d in messages],
+                             [(1, 'hello0'), (2, 'hello1'), (3, 'hello2')])
+        self.assertTrue(self.redis.execute_command('XLEN', 'room:101:stream') >= 3)
+
+    @gen_test
+    def test_cursor_starts_at_tail(self):
+        # 加入前stream里已有的消息不再投递
+        old = webchat.encode_message(dict(type='message', data='old', seq=1))
+        self.redis.execute_command('XADD', 'room:102:stream', '*', 'm', old)
+        conn = yield self.connect(102)
+        backend = self._app.settings['hub'].backend
+        yield self.wait_for(lambda: 'room:102:stream' in backend.cursors)
+        conn.write_message('new')
+        messages = yield self.read_messages(conn, 1)
+        self.assertEqual((messages[0]['seq'], messages[0]['data']), (1, 'new'))
+
+
+class FakeExecutor(object):
+    """按顺序返回预先给定的结果"""
+
+    def __init__(self, *results):
+        self.results = list(results)
+
+    def execute(self, commands, callback=None):
+        if callback is not None:
+            callback(self.results.pop(0))
+
+
+class StreamSubscribeTestCase(AsyncTestCase):
+    """
+    stream游标的初始化
+    """
+
+    def backend(self, *results):
+        hub = type('Hub', (object,), dict(inbox='node:test', rooms={'room:1': set([1])}))()
+        backend = webchat.StreamBackend(hub, FakeExecutor(*results),
+                                        dict(REDIS_HOST='localhost', REDIS_PORT=6379))
+        backend.RECONNECT_DELAY = 0.01
+        return backend
+
+    @gen_test
+    def test_cursor(self):
+        backend = self.backend([[['5-0', ['m', 'x']]]])
+        backend.subscribe('room:1')
+        self.assertEqual(backend.cursors['room:1:stream'], '5-0')
+
+    @gen_test
+    def test_empty_stream(self):
+        backend = self.backend([[]])
+        backend.subscribe('room:1')
+        self.assertEqual(backend.cursors['room:1:stream'], '0-0')
+
+    @gen_test
+    def test_retry_on_error(self):
+        # 查询失败时不能从0-0开始读, 稍后重试
+        backend = self.backend(None, [[['7-0', ['m', 'x']]]])
+        backend.subscribe('room:1')
+        self.assertNotIn('room:1:stream', backend.cursors)
+        yield gen.sleep(0.05)
+        self.assertEqual(backend.cursors['room:1:stream'], '7-0')
+
+
+class RegistryTestCase(RedisTestCase):
+    """
+    房间占用表: 只有本节点有人的房间不经过redis投递
+    """
+    CONFIG = dict(
+        WebchatTestCase.CONFIG,
+        DELIVERY_BACKEND='pubsub',
+        REDIS_HOST='localhost',
+        REDIS_PORT=6379,
+        ROOM_REGISTRY_TTL=60,
+        REPLAY_SIZE=0,
+    )
+    ROOMS = (201,)
+
+    @gen_test
+    def test_local_and_contended(self):
+        hub = self._app.settings['hub']
+        registry = hub.registry
+        conn = yield self.connect(201)
+        yield self.wait_for(lambda: registry.is_local('room:201'))
+        conn.write_message('local')
+        messages = yield self.read(conn)
+        self.assertEqual((messages[0]['seq'], messages[0]['data']), (1, 'local'))
+        self.assertEqual(registry.local_published, 1)
+
+        # 其他节点已经登记但还没收到它的加入通知, 消息由redis投递, 本节点不再自己分发
+        self.redis.zadd('room:201:nodes', time.time() + 60, 'other:1')
+        conn.write_message('contended')
+        messages = yield self.read(conn)
+        self.assertEqual((messages[0]['seq'], messages[0]['data']), (2, 'contended'))
+        self.assertIn('room:201', registry.contended)
+        self.assertFalse(registry.is_local('room:201'))
+        self.assertEqual(registry.local_published, 1)
+
+        # 刷新后读到其他节点, 离开后又回到本地
+        registry.refresh()
+        yield self.wait_for(lambda: 'room:201' not in registry.contended)
+        self.assertEqual(registry.remote['room:201'], set(['other:1']))
+        self.redis.zrem('room:201:nodes', 'other:1')
+        registry.refresh()
+        yield self.wait_for(lambda: registry.is_local('room:201'))
+        conn.write_message('again')
+        messages = yield self.read(conn)
+        self.assertEqual((messages[0]['seq'], messages[0]['data']), (3, 'again'))
+        self.assertEqual(registry.local_published, 2)
+
+
+class FakePublisher(object):
+    """记录命令, 由测试给出redis的结果"""
+
+    def __init__(self):
+        self.calls = []
+        self.published = []
+
+    def execute(self, commands, callback=None):
+        self.calls.append((commands, callback))
+
+    def publish(self, channel, message, history=True):
+        self.published.append((channel, webchat.decode_message(message)['data']))
+
+
+class RoomRegistryTestCase(unittest.TestCase):
+    """
+    占用表状态变化
+    """
+
+    def setUp(self):
+        self.publisher = FakePublisher()
+        hub = type('Hub', (object,), dict(node_id='me'))()
+        self.registry = webchat.RoomRegistry(hub, self.publisher)
+
+    def reply(self, *results):
+        commands, callback = self.publisher.calls.pop(0)
+        callback(list(results))
+
+    def test_join_alone(self):
+        waited = []
+        self.registry.join('room:1')
+        self.registry.wait('room:1', lambda: waited.append(1))
+        self.assertFalse(self.registry.is_local('room:1'))
+        self.reply(1, 1, ['me'])
+        # 只有本节点时不广播加入通知
+        self.assertTrue(self.registry.is_local('room:1'))
+        self.assertEqual(waited, [1])
+        self.assertEqual(self.publisher.published, [])
+
+    def test_join_shared(self):
+        self.registry.join('room:1')
+        self.reply(1, 1, ['me', 'other'])
+        self.assertFalse(self.registry.is_local('room:1'))
+        self.assertEqual(self.publisher.published, [('room:1', 'join me')])
+
+    def test_notices(self):
+        self.registry.join('room:1')
+        self.reply(1, 1, ['me'])
+        notice = webchat.encode_message(dict(type='node', data='join other'))
+        self.registry.on_notice('room:1', notice)
+        self.assertFalse(self.registry.is_local('room:1'))
+        notice = webchat.encode_message(dict(type='node', data='leave other'))
+        self.registry.on_notice('room:1', notice)
+        self.assertTrue(self.registry.is_local('room:1'))
+
+    def test_contended_until_refresh(self):
+        self.registry.join('room:1')
+        self.reply(1, 1, ['me'])
+        self.registry.contended.add('room:1')
+        self.assertFalse(self.registry.is_local('room:1'))
+        self.registry.refresh()
+        self.reply(1, 1, 0, ['me'])
+        self.assertTrue(self.registry.is_local('room:1'))
+
+    def test_join_during_refresh(self):
+        # 刷新在途时收到的加入通知不会被刷新结果覆盖
+        self.registry.join('room:1')
+        self.reply(1, 1, ['me'])
+        self.registry.refresh()
+        notice = webchat.encode_message(dict(type='node', data='join other'))
+        self.registry.on_notice('room:1', notice)
+        self.reply(1, 1, 0, ['me'])
+        self.assertEqual(self.registry.remote['room:1'], set(['other']))
+
+    def test_leave(self):
+        self.registry.join('room:1')
+        self.reply(1, 1, ['me'])
+        self.registry.leave('room:1')
+        # 只有本节点的房间离开时也不广播
+        self.assertEqual(self.publisher.published, [])
+        self.assertEqual(self.publisher.calls[0][0], [('ZREM', 'room:1:nodes', 'me')])
+        self.assertFalse(self.registry.is_local('room:1'))
+
+
+class FakeMetrics(object):
+
+    def incr(self, channel, name, value=1):
+        pass
+
+
+class FakeStream(object):
+    """记录写入和写空回调, busy表示写缓冲里还有数据"""
+
+    def __init__(self):
+        self.busy = False
+        self.data = []
+        self.callbacks = []
+
+    def writing(self):
+        return self.busy
+
+    def write(self, data, callback=None):
+        if data:
+            self.data.append(data)
+        if callback is not None:
+            self.callbacks.append(callback)
+
+
+class FakeHandler(object):
+    """只带出队列和心跳需要的属性的连接"""
+    DROP_OLDEST = webchat.RoomDemo.DROP_OLDEST
+    COLLAPSE = webchat.RoomDemo.COLLAPSE
+    DISCONNECT = webchat.RoomDemo.DISCONNECT
+    send_frame = webchat.RoomDemo.send_frame.__func__
+    _enqueue = webchat.RoomDemo._enqueue.__func__
+    _write = webchat.RoomDemo._write.__func__
+    _drain = webchat.RoomDemo._drain.__func__
+
+    def __init__(self, policy=webchat.RoomDemo.DROP_OLDEST, size=3):
+        self.hub = type('Hub', (object,), dict(metrics=FakeMetrics()))()
+        self.channels = 'room:1'
+        self.outbox = webchat.deque()
+        self.outbox_size = size
+        self.outbox_policy = policy
+        self.outbox_close_code = 1013
+        self.missed = 0
+        self.draining = False
+        self.replaying = False
+        self.stream = FakeStream()
+        self.closed = None
+        self.pings = 0
+        self.aborted = False
+        self.ws_connection = self
+        self.heartbeat_slot = None
+        self.awaiting_pong = False
+        self.ping_sent = 0
+        self.last_active = time.time()
+
+    def close(self, code=None, reason=None):
+        self.closed = code
+
+    def ping(self, data):
+        self.pings += 1
+
+    def _abort(self):
+        self.aborted = True
+
+
+class OutboxTestCase(unittest.TestCase):
+    """
+    慢连接出队列策略
+    """
+
+    def fill(self, handler, count):
+        for i in range(count):
+            handler._enqueue('frame%d' % i, 'payload%d' % i)
+
+    def test_drop_oldest(self):
+        handler = FakeHandler(webchat.RoomDemo.DROP_OLDEST)
+        self.fill(handler, 5)
+        self.assertEqual([frame for frame, payload in handler.outbox], ['frame2', 'frame3', 'frame4'])
+        self.assertIsNone(handler.closed)
+
+    def test_collapse(self):
+        handler = FakeHandler(webchat.RoomDemo.COLLAPSE)
+        self.fill(handler, 5)
+        # 队列满时清空并记下丢掉的条数, 写出时先发missed通知
+        self.assertEqual([frame for frame, payload in handler.outbox], ['frame3', 'frame4'])
+        self.assertEqual(handler.missed, 3)
+
+    def test_disconnect(self):
+        handler = FakeHandler(webchat.RoomDemo.DISCONNECT)
+        self.fill(handler, 4)
+        self.assertEqual(handler.closed, 1013)
+        self.assertEqual(len(handler.outbox), 0)
+
+    def test_drain_after_internal_write(self):
+        handler = FakeHandler()
+        # 写缓冲里是tornado自己写的ping帧, 没有注册写空回调
+        handler.stream.busy = True
+        handler.send_frame('frame0', 'payload0')
+        handler.send_frame('frame1', 'payload1')
+        self.assertEqual(len(handler.outbox), 2)
+        self.assertEqual(len(handler.stream.callbacks), 1)
+        handler.stream.busy = False
+        handler.stream.callbacks.pop()()
+        self.assertEqual(handler.stream.data, ['frame0frame1'])
+        self.assertEqual(len(handler.outbox), 0)
+        self.assertFalse(handler.draining)
+
+
+class HeartbeatTestCase(unittest.TestCase):
+    """
+    心跳时间轮
+    """
+
+    def setUp(self):
+        # ping间隔3秒, pong期限1秒: 加入2个tick后发ping, 再1个tick检查pong
+        self.wheel = webchat.HeartbeatWheel(ping_interval=3, pong_timeout=1, idle_timeout=0)
+
+    def tick(self, count):
+        for i in range(count):
+            self.wheel.on_tick()
+
+    def test_reap(self):
+        handler = FakeHandler()
+        self.wheel.add(handler)
+        self.tick(2)
+        self.assertEqual(handler.pings, 1)
+        self.assertTrue(handler.awaiting_pong)
+        # pong期限内没有回应
+        self.tick(1)
+        self.assertTrue(handler.aborted)
+        self.assertEqual(self.wheel.stats()['reaped'], 1)
+        self.assertEqual(self.wheel.stats()['connections'], 0)
+
+    def test_pong(self):
+        handler = FakeHandler()
+        self.wheel.add(handler)
+        self.tick(2)
+        self.wheel.on_pong(handler)
+        self.tick(1)
+        self.assertFalse(handler.aborted)
+        # 收到pong后到ping间隔再发下一次ping
+        self.tick(2)
+        self.assertEqual(handler.pings, 2)
+
+    def test_remove(self):
+        handler = FakeHandler()
+        self.wheel.add(handler)
+        self.wheel.remove(handler)
+        self.tick(5)
+        self.assertEqual(handler.pings, 0)
+        self.assertEqual(self.wheel.stats()['connections'], 0)
+
+    def test_idle(self):
+        self.wheel.idle_timeout = 10
+        handler = FakeHandler()
+        handler.last_active = time.time() - 60
+        self.wheel.add(handler)
+        self.tick(2)
+        self.assertEqual(handler.closed, 1000)
+        self.assertEqual(handler.pings, 0)
+        self.assertEqual(self.wheel.stats()['idle_reaped'], 1)
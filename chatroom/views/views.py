@@ -1,9 +1,9 @@
 # coding: utf-8
 from rest_framework.compat import is_authenticated
 from chatroom.permissions import IsOwnerOrCreateOnly
-from rest_framework import generics, mixins, authentication, viewsets
+from rest_framework import generics, mixins, authentication, viewsets, permissions
 from rest_framework.exceptions import ValidationError
-from chatroom.models.user import UserProfile, User
+from chatroom.models.user import UserProfile, User, Usership
 from chatroom.models.email import VerifyEmail
 from chatroom.base import const
 from chatroom.base.log import print_log
@@ -81,3 +81,15 @@ class UserViewSet(mixins.CreateModelMixin,
 
     def put(self, request, *args, **kwargs):
         return self.update(request, *args, **kwargs)
+
+
+class ChatTokenView(generics.GenericAPIView):
+    """
+    签发webchat身份令牌, 连接时带上?token=, 同时刷新好友集合供私信校验
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def get(self, request, *args, **kwargs):
+        uid = request.user.id
+        Usership.cache_friends(uid)
+        return Response(dict(uid=uid, token=util.sign_chat_token(uid), ttl=ST.CHAT_TOKEN_TTL))
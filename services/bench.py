@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Desc    :   webchat压测工具
+#
+#   python services/bench.py --clients 2000 --rooms 200 --rate 500 --duration 30
+#
+#   在子进程里用init_app()启动服务, 本进程建立大量websocket客户端分布在多个房间,
+#   按给定速率随机挑选客户端发消息, 统计端到端投递延迟分位数, 吞吐, 每连接内存
+#   和redis命令数, 结果以json输出便于不同版本之间对比
+#
+
+
+import argparse
+import json
+import os
+import random
+import resource
+import signal
+import sys
+import time
+
+from tornado import gen
+from tornado.httpclient import HTTPRequest
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.websocket import websocket_connect
+
+import webchat
+
+MARK = "bench:"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="webchat benchmark")
+    parser.add_argument("--clients", type=int, default=1000, help="websocket连接数")
+    parser.add_argument("--rooms", type=int, default=100, help="房间数, 连接均匀分布")
+    parser.add_argument("--rate", type=float, default=200, help="每秒发送的消息总数")
+    parser.add_argument("--duration", type=float, default=10, help="发送持续秒数")
+    parser.add_argument("--size", type=int, default=64, help="消息体字节数")
+    parser.add_argument("--port", type=int, default=11100)
+    parser.add_argument("--backend", default=None, help="覆盖DELIVERY_BACKEND")
+    parser.add_argument("--settle", type=float, default=2, help="连接后等待多少秒没有新消息再开始发送")
+    parser.add_argument("--concurrency", type=int, default=200, help="同时发起的连接数")
+    parser.add_argument("--binary", action="store_true", help="客户端使用pigroom.bin消息格式")
+    parser.add_argument("--keep-limits", action="store_true", help="保留配置里的限流")
+    parser.add_argument("--output", default=None, help="结果json写入文件, 默认输出到stdout")
+    return parser.parse_args()
+
+
+def rss_kb(pid):
+    with open("/proc/%d/status" % pid) as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def redis_commands(cfg):
+    """redis各命令累计调用次数, 内存后端或连不上redis时返回None"""
+    if cfg.get("DELIVERY_BACKEND") == webchat.MemoryBroker.name:
+        return None
+    try:
+        import redis
+        stats = redis.StrictRedis(cfg["REDIS_HOST"], cfg["REDIS_PORT"]).info("commandstats")
+    except Exception:
+        return None
+    return dict((key[len("cmdstat_"):], value["calls"]) for key, value in stats.items())
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    index = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def start_server(cfg, port):
+    pid = os.fork()
+    if pid == 0:
+        signal.signal(signal.SIGTERM, lambda *args: os._exit(0))
+        app = webchat.init_app(cfg)
+        server = HTTPServer(app)
+        server.listen(port, address="127.0.0.1")
+        IOLoop.current().start()
+        os._exit(0)
+    return pid
+
+
+class Bench(object):
+
+    def __init__(self, args, cfg):
+        self.args = args
+        self.cfg = cfg
+        self.clients = []
+        self.latencies = []
+        self.sent = 0
+        self.received = 0
+        self.errors = 0
+        self.closed = 0
+        self.started = None
+        self.last_received = 0
+        self.payload = "x" * max(0, args.size - len(MARK) - 18)
+
+    @gen.coroutine
+    def connect(self, index):
+        token = webchat.sign_token(index + 1, self.cfg["CHAT_TOKEN_SECRET"])
+        url = "ws://127.0.0.1:%d/pigroom/ws/%d?token=%s" % (
+            self.args.port, index % self.args.rooms + 1, token)
+        if self.args.binary:
+            url = HTTPRequest(url, headers={"Sec-WebSocket-Protocol": "pigroom.bin"})
+        try:
+            conn = yield websocket_connect(url)
+        except Exception:
+            self.errors += 1
+            return
+        self.clients.append(conn)
+        self.read(conn)
+
+    @gen.coroutine
+    def read(self, conn):
+        while True:
+            message = yield conn.read_message()
+            if message is None:
+                self.closed += 1
+                return
+            self.last_received = time.time()
+            d = webchat.decode_message(message)
+            data = d.get("data")
+            if d.get("type") == "message" and isinstance(data, basestring) and data.startswith(MARK):
+                sent = float(data[len(MARK):].split("|", 1)[0])
+                # 进房间时回放的是之前发送的历史消息, 不计入
+                if self.started is None or sent < self.started:
+                    continue
+                self.latencies.append(time.time() - sent)
+                self.received += 1
+            elif d.get("type") == "error":
+                self.errors += 1
+
+    def send(self, count):
+        for __ in range(count):
+            conn = random.choice(self.clients)
+            conn.write_message("%s%.6f|%s" % (MARK, time.time(), self.payload))
+            self.sent += 1
+
+    @gen.coroutine
+    def run(self, server_pid):
+        args = self.args
+        yield gen.sleep(0.5)
+        rss_before = rss_kb(server_pid)
+        commands_before = redis_commands(self.cfg)
+
+        start = time.time()
+        for i in range(0, args.clients, args.concurrency):
+            yield [self.connect(index) for index in range(i, min(i + args.concurrency, args.clients))]
+        connect_time = time.time() - start
+        # 等回放和加入通知发完
+        deadline = time.time() + 30
+        while time.time() - self.last_received < args.settle and time.time() < deadline:
+            yield gen.sleep(0.1)
+        rss_connected = rss_kb(server_pid)
+
+        tick = 0.01
+        state = dict(credit=0.0)
+
+        def on_tick():
+            state["credit"] += args.rate * tick
+            count = int(state["credit"])
+            state["credit"] -= count
+            if count and self.clients:
+                self.send(count)
+
+        timer = PeriodicCallback(on_tick, tick * 1000)
+        start = self.started = time.time()
+        timer.start()
+        yield gen.sleep(args.duration)
+        timer.stop()
+        send_time = time.time() - start
+        yield gen.sleep(1)
+        elapsed = time.time() - start
+
+        commands_after = redis_commands(self.cfg)
+        commands = None
+        if commands_before is not None and commands_after is not None:
+            commands = dict((name, calls - commands_before.get(name, 0))
+                            for name, calls in commands_after.items()
+                            if calls != commands_before.get(name, 0))
+
+        latencies = sorted(self.latencies)
+        ms = lambda value: round(value * 1000, 3) if value is not None else None
+        connected = len(self.clients)
+        result = dict(
+            config=dict(clients=args.clients, rooms=args.rooms, rate=args.rate,
+                        duration=args.duration, size=args.size, binary=args.binary,
+                        backend=self.cfg.get("DELIVERY_BACKEND", "pubsub")),
+            connections=dict(connected=connected, connect_seconds=round(connect_time, 3),
+                             closed=self.closed, errors=self.errors),
+            throughput=dict(sent=self.sent, delivered=self.received,
+                            sent_per_second=round(self.sent / send_time, 1),
+                            delivered_per_second=round(self.received / elapsed, 1)),
+            latency_ms=dict(p50=ms(percentile(latencies, 50)), p90=ms(percentile(latencies, 90)),
+                            p99=ms(percentile(latencies, 99)), p999=ms(percentile(latencies, 99.9)),
+                            max=ms(latencies[-1] if latencies else None)),
+            memory=dict(server_rss_kb=rss_connected,
+                        per_connection_kb=round(float(rss_connected - rss_before) / connected, 2)
+                        if connected else None),
+            redis_commands=commands,
+        )
+        raise gen.Return(result)
+
+
+def main():
+    args = parse_args()
+    cfg = webchat.load_config()
+    if args.backend:
+        cfg["DELIVERY_BACKEND"] = args.backend
+    if not cfg.get("CHAT_TOKEN_SECRET"):
+        cfg["CHAT_TOKEN_SECRET"] = os.urandom(16).encode("hex")
+    if not args.keep_limits:
+        for key in ("RATE_CONN_RATE", "RATE_ROOM_RATE", "RATE_USER_RATE"):
+            cfg[key] = 0
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = args.clients * 2 + 100
+    if soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(wanted, hard), hard))
+
+    server_pid = start_server(cfg, args.port)
+    try:
+        result = IOLoop.current().run_sync(lambda: Bench(args, cfg).run(server_pid))
+    finally:
+        os.kill(server_pid, signal.SIGTERM)
+        os.waitpid(server_pid, 0)
+
+    output = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print output
+    latency = result["latency_ms"]
+    sys.stderr.write("%d clients / %d rooms: %s msg/s delivered, p50 %sms p99 %sms\n" % (
+        result["connections"]["connected"], args.rooms,
+        result["throughput"]["delivered_per_second"], latency["p50"], latency["p99"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -8,73 +8,2110 @@
 #
 
 
+import bisect
+import errno
+import hashlib
+import hmac
 import json
+import logging
+import os
 import signal
+import socket
+import struct
+import sys
+import time
+import traceback
+import zlib
+from collections import Counter, deque
+from datetime import timedelta
 
-from tornado.gen import engine, Task
-from tornado.ioloop import IOLoop
-from tornado.web import Application
-from tornado.websocket import WebSocketHandler
+from tornado.gen import engine, sleep, Task, TimeoutError, with_timeout
+from tornado.escape import utf8
+from tornado.httpserver import HTTPServer
+from tornado.iostream import StreamClosedError
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.log import enable_pretty_logging
+from tornado.netutil import bind_sockets
+from tornado.process import cpu_count
+from tornado.web import Application, RequestHandler, asynchronous
+from tornado.websocket import WebSocketClosedError, WebSocketHandler, WebSocketProtocol13
 
 import tornadoredis
+from tornadoredis.exceptions import ResponseError
 
-import redis
+log = logging.getLogger("webchat")
 
-RedisDB = redis.StrictRedis("127.0.0.1", 6379, 0)
 
-class RoomDemo(WebSocketHandler):
-    FINISH_MSG = json.dumps(dict(type='state', data='finish'))
+def build_frame(payload, binary=False, compressed=False):
+    """按RFC 6455组装一个未掩码的服务端数据帧, 同一条消息只组帧一次
+    compressed为True时payload是permessage-deflate压缩过的, 置RSV1位
+    """
+    opcode = 0x2 if binary else 0x1
+    if compressed:
+        opcode |= 0x40
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", 0x80 | opcode, length)
+    elif length <= 0xFFFF:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+    return header + payload
+
+
+def parse_message(body):
+    """解析消息, 非法消息返回空dict"""
+    try:
+        d = json.loads(body)
+    except (TypeError, ValueError):
+        return dict()
+    return d if isinstance(d, dict) else dict()
+
+
+def sign_token(uid, secret, ttl=86400):
+    """签发身份令牌 "<uid>:<过期时间>:<签名>", 签名是HMAC-SHA256(secret, "<uid>:<过期时间>"),
+    与API(chatroom.base.util.sign_chat_token)签发的格式相同"""
+    payload = "%s:%d" % (uid, int(time.time() + ttl))
+    return "%s:%s" % (payload, hmac.new(utf8(secret), payload, hashlib.sha256).hexdigest())
+
+
+def verify_token(token, secret):
+    """校验身份令牌, 通过返回uid, 否则返回None"""
+    if not secret or not token:
+        return None
+    parts = utf8(token).split(":")
+    if len(parts) != 3:
+        return None
+    uid, expiry, signature = parts
+    if not uid.isdigit() or not expiry.isdigit() or int(expiry) < time.time():
+        return None
+    expected = hmac.new(utf8(secret), "%s:%s" % (uid, expiry), hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(expected, signature):
+        return None
+    return uid
+
+
+# 紧凑消息格式, redis里保存的和发给pigroom.bin客户端的都是这种格式:
+# 定长头部 类型(1) + seq(12位十进制) + ts(16位十进制, 微秒), 后面是data原文.
+# 头部全是ASCII, tornadoredis把回复按utf-8解码也不会出错; 服务端只看头部, 不解析data.
+# 带有其他字段的控制消息类型记为J, 头部后面是完整的json
+HEADER_SIZE = 29
+KINDS = dict(message='M', state='S', error='E', node='N')
+TYPES = dict((kind, name) for name, kind in KINDS.items())
+JSON_KIND = 'J'
+FIELDS = frozenset(('type', 'data', 'seq', 'ts'))
+
+
+def encode_message(d):
+    """dict转成紧凑格式, ts的单位是秒"""
+    kind = KINDS.get(d.get('type'))
+    data = d.get('data')
+    header = "%012d%016d" % (d.get('seq') or 0, int((d.get('ts') or 0) * 1000000))
+    if kind is None or not isinstance(data, basestring) or set(d) - FIELDS:
+        return JSON_KIND + header + json.dumps(d)
+    return kind + header + utf8(data)
+
+
+def message_header(body):
+    """只解析头部, 返回(类型, seq, ts), 兼容旧的json格式"""
+    if body[:1] == '{':
+        d = parse_message(body)
+        return KINDS.get(d.get('type'), JSON_KIND), d.get('seq', 0), d.get('ts', 0)
+    try:
+        return body[:1], int(body[1:13]), int(body[13:HEADER_SIZE]) / 1000000.0
+    except ValueError:
+        return JSON_KIND, 0, 0
+
+
+def decode_message(body):
+    """紧凑格式转成dict, 非法消息返回空dict"""
+    kind = body[:1]
+    if kind == '{':
+        return parse_message(body)
+    if kind == JSON_KIND:
+        return parse_message(body[HEADER_SIZE:])
+    if kind not in TYPES:
+        return dict()
+    kind, seq, ts = message_header(body)
+    d = dict(type=TYPES[kind], data=utf8(body[HEADER_SIZE:]).decode('utf-8', 'replace'))
+    if seq:
+        d['seq'] = seq
+    if ts:
+        d['ts'] = ts
+    return d
+
+
+def wire_frame(body, binary=False, deflater=None):
+    """按客户端协商的格式组帧, 返回(frame, payload), payload是压缩前的内容
+    pigroom.bin客户端直接转发紧凑格式, 其他客户端转成json; 协商了压缩的连接由deflater压缩
+    """
+    body = utf8(body)
+    if binary:
+        payload = body if body[:1] != '{' else encode_message(parse_message(body))
+    elif body[:1] == '{':
+        payload = body
+    elif body[:1] == JSON_KIND:
+        payload = body[HEADER_SIZE:]
+    else:
+        payload = json.dumps(decode_message(body))
+    if deflater is not None and len(payload) >= deflater.min_size:
+        return build_frame(deflater.compress(payload), binary, True), payload
+    return build_frame(payload, binary), payload
+
+
+class Deflater(object):
+    """permessage-deflate压缩
+    握手时要求server_no_context_takeover, 每条消息单独压缩, 同一条消息对所有连接的压缩结果相同,
+    广播时只压缩一次, 连接上也不用常驻zlib压缩窗口. 小于min_size的消息不压缩
+    """
+
+    def __init__(self, level=6, mem_level=8, window_bits=15, min_size=256, client_no_context=False):
+        self.level = level
+        self.mem_level = mem_level
+        # zlib不支持8位的raw deflate窗口
+        self.window_bits = min(max(window_bits, 9), 15)
+        self.min_size = min_size
+        self.client_no_context = client_no_context
+        self.messages = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0.0
+
+    def accepts(self, offered_parameters):
+        """压缩结果由所有连接共用, 不能按连接缩小窗口, 客户端要求的窗口比配置的小时不接受"""
+        if 'server_max_window_bits' not in offered_parameters:
+            return True
+        bits = offered_parameters['server_max_window_bits'] or ''
+        return bits.isdigit() and self.window_bits <= int(bits) <= 15
+
+    def negotiate(self, agreed_parameters):
+        """修改回给客户端的扩展参数"""
+        agreed_parameters['server_no_context_takeover'] = None
+        if self.window_bits < 15:
+            agreed_parameters['server_max_window_bits'] = str(self.window_bits)
+        if self.client_no_context:
+            # 客户端也不保留上下文, 服务端每个连接不用常驻解压窗口
+            agreed_parameters['client_no_context_takeover'] = None
+
+    def compress(self, data):
+        start = time.time()
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -self.window_bits, self.mem_level)
+        compressed = (compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH))[:-4]
+        self.seconds += time.time() - start
+        self.messages += 1
+        self.bytes_in += len(data)
+        self.bytes_out += len(compressed)
+        return compressed
+
+    def stats(self):
+        return dict(
+            messages=self.messages,
+            bytes_in=self.bytes_in,
+            bytes_out=self.bytes_out,
+            ratio=float(self.bytes_out) / self.bytes_in if self.bytes_in else 0,
+            seconds=self.seconds,
+        )
+
+
+class DeflateProtocol(WebSocketProtocol13):
+    """发送方向的压缩由Deflater完成, tornado只负责解压客户端的消息"""
+
+    def _parse_extensions_header(self, headers):
+        # 去掉Deflater无法满足的压缩参数, 都不满足时不启用压缩
+        deflater = self._compression_options and self._compression_options['deflater']
+        extensions = super(DeflateProtocol, self)._parse_extensions_header(headers)
+        return [ext for ext in extensions
+                if ext[0] != 'permessage-deflate' or deflater is None or deflater.accepts(ext[1])]
+
+    def _create_compressors(self, side, agreed_parameters):
+        deflater = self._compression_options['deflater']
+        deflater.negotiate(agreed_parameters)
+        super(DeflateProtocol, self)._create_compressors(side, agreed_parameters)
+        self._compressor = None
+        self.handler.deflater = deflater
+
+
+class Script(object):
+    """pipeline里用EVALSHA执行的lua脚本"""
+
+    def __init__(self, source):
+        self.source = source
+        self.sha = hashlib.sha1(source).hexdigest()
+
+    def command(self, keys, args):
+        return ('EVALSHA', self.sha, len(keys)) + tuple(keys) + tuple(args)
+
+
+# 原子地分配房间内递增的seq, 写入定长历史后再投递, 返回{seq, 是否已投递}.
+# 带了node时只要房间占用表里没有其他节点就不投递, 由本节点自己分发; 与其他节点的登记在redis里
+# 串行, 登记之后的消息一定会投递, 登记之前的由该节点进房间时的历史回放补齐
+# KEYS: seq, history, channel或stream[, 房间占用表]
+# ARGV: message(紧凑格式), history_size, 投递方式, stream_maxlen[, node, now]
+APPEND_SCRIPT = Script("""
+local seq = redis.call('INCR', KEYS[1])
+local message = string.sub(ARGV[1], 1, 1) .. string.format('%012d', seq) .. string.sub(ARGV[1], 14)
+redis.call('RPUSH', KEYS[2], message)
+redis.call('LTRIM', KEYS[2], -tonumber(ARGV[2]), -1)
+local deliver = 1
+if ARGV[5] then
+    deliver = 0
+    for _, node in ipairs(redis.call('ZRANGEBYSCORE', KEYS[4], ARGV[6], '+inf')) do
+        if node ~= ARGV[5] then
+            deliver = 1
+            break
+        end
+    end
+end
+if deliver == 1 then
+    if ARGV[3] == 'stream' then
+        redis.call('XADD', KEYS[3], 'MAXLEN', '~', ARGV[4], '*', 'm', message)
+    else
+        redis.call('PUBLISH', KEYS[3], message)
+    end
+end
+return {seq, deliver}
+""")
+
+# 取出seq大于since的历史记录, 返回{当前seq, 记录列表}
+# KEYS: seq, history  ARGV: since
+RESUME_SCRIPT = Script("""
+local last = tonumber(redis.call('GET', KEYS[1]) or '0')
+local count = last - tonumber(ARGV[1])
+if count <= 0 then
+    return {last, {}}
+end
+return {last, redis.call('LRANGE', KEYS[2], -count, -1)}
+""")
+
+# 批量判断用户是否在线, 任一节点的登记未过期即在线, 返回与KEYS对应的0/1列表
+# KEYS: presence:<uid>...  ARGV: now
+ONLINE_SCRIPT = Script("""
+local result = {}
+for i, key in ipairs(KEYS) do
+    result[i] = 0
+    for _, expire in ipairs(redis.call('HVALS', key)) do
+        if tonumber(expire) > tonumber(ARGV[1]) then
+            result[i] = 1
+            break
+        end
+    end
+end
+return result
+""")
+
+# 登记用户在本节点上线, 同时取出并清空离线私信
+# KEYS: presence:<uid>, backlog:<uid>  ARGV: node, 过期时间, ttl
+REGISTER_SCRIPT = Script("""
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+local backlog = redis.call('LRANGE', KEYS[2], 0, -1)
+redis.call('DEL', KEYS[2])
+return backlog
+""")
 
-    def initialize(self, **kws):
-        self.client = tornadoredis.Client(host=kws["REDIS_HOST"], port=kws["REDIS_PORT"])
+# 把私信投递到接收者所在各节点的收件频道, 接收者不在线时写入离线私信, 返回投递的节点数,
+# 接收者不在发送者的好友集合(由API按Usership维护)里时返回-1
+# KEYS: presence:<to>, backlog:<to>, friends:<from>
+# ARGV: 消息, now, 投递方式, backlog_size, backlog_ttl, stream_maxlen, to, 是否校验好友
+DIRECT_SCRIPT = Script("""
+if ARGV[8] == '1' and redis.call('SISMEMBER', KEYS[3], ARGV[7]) == 0 then
+    return -1
+end
+local delivered = 0
+local nodes = redis.call('HGETALL', KEYS[1])
+for i = 1, #nodes, 2 do
+    if tonumber(nodes[i + 1]) > tonumber(ARGV[2]) then
+        local inbox = 'node:' .. nodes[i]
+        if ARGV[3] == 'stream' then
+            redis.call('XADD', inbox .. ':stream', 'MAXLEN', '~', ARGV[6], '*', 'm', ARGV[1])
+            redis.call('EXPIRE', inbox .. ':stream', ARGV[5])
+        else
+            redis.call('PUBLISH', inbox, ARGV[1])
+        end
+        delivered = delivered + 1
+    end
+end
+if delivered == 0 then
+    redis.call('RPUSH', KEYS[2], ARGV[1])
+    redis.call('LTRIM', KEYS[2], -tonumber(ARGV[4]), -1)
+    redis.call('EXPIRE', KEYS[2], ARGV[5])
+end
+return delivered
+""")
+
+# 私信到达时接收者已离开本节点: 没有其他节点还登记着接收者(说明已经转给了那里的连接)时
+# 才写入离线私信, 返回是否写入
+# KEYS: presence:<uid>, backlog:<uid>  ARGV: 消息, now, node, backlog_size, backlog_ttl
+BACKLOG_SCRIPT = Script("""
+local nodes = redis.call('HGETALL', KEYS[1])
+for i = 1, #nodes, 2 do
+    if nodes[i] ~= ARGV[3] and tonumber(nodes[i + 1]) > tonumber(ARGV[2]) then
+        return 0
+    end
+end
+redis.call('RPUSH', KEYS[2], ARGV[1])
+redis.call('LTRIM', KEYS[2], -tonumber(ARGV[4]), -1)
+redis.call('EXPIRE', KEYS[2], ARGV[5])
+return 1
+""")
+
+
+class Subscriber(object):
+    """一条常驻的订阅连接, 由PubSubBackend按房间分片使用
+    连接建立后始终订阅本节点的控制频道, 保证房间全部退订后listen循环也不会退出
+    """
+    RECONNECT_DELAY = 1
+
+    def __init__(self, hub, host, port, control):
+        self.hub = hub
+        self.host = host
+        self.port = port
+        self.control = control
+        self.channels = set()
+        self.client = None
+        self.ready = False
 
     @engine
-    def listen(self, channels):
-        self.client.connect()
-        yield Task(self.client.subscribe, channels)
-        self.client.listen(self.on_subscribe)
+    def connect(self):
+        self.ready = False
+        channels = set(self.channels)
+        try:
+            self.client = tornadoredis.Client(host=self.host, port=self.port)
+            self.client.connect()
+            yield Task(self.client.subscribe, [self.control] + list(channels))
+        except Exception:
+            log.exception("subscriber connect failed")
+            self.reconnect()
+            return
+        self.ready = True
+        self.client.listen(self.on_message)
+        # 连接期间新加入的房间
+        pending = self.channels - channels
+        if pending:
+            self.client.subscribe(list(pending))
+
+    def reconnect(self):
+        IOLoop.current().call_later(self.RECONNECT_DELAY, self.connect)
+
+    def subscribe(self, channel):
+        self.channels.add(channel)
+        if self.ready:
+            self.client.subscribe(channel)
+
+    def unsubscribe(self, channel):
+        self.channels.discard(channel)
+        if self.ready:
+            self.client.unsubscribe(channel)
+
+    def on_message(self, msg):
+        if msg.kind == 'message':
+            self.hub.dispatch(msg)
+        elif msg.kind == 'disconnect':
+            log.warning("subscriber lost connection to redis, reconnecting")
+            self.ready = False
+            self.reconnect()
+
+    def close(self):
+        self.ready = False
+        if self.client is not None:
+            self.client.disconnect()
+
+
+class PubSubBackend(object):
+    """用PUBLISH/SUBSCRIBE投递房间消息, 房间按频道名分片到若干条订阅连接上"""
+    name = 'pubsub'
+
+    def __init__(self, hub, publisher, cfg):
+        self.hub = hub
+        pool_size = max(1, cfg.get("SUBSCRIBER_POOL_SIZE", 1))
+        self.subscribers = []
+        for i in range(pool_size):
+            # 第一条连接的控制频道同时是本节点的私信收件频道
+            control = hub.inbox
+            if i:
+                control += ":%d" % i
+            self.subscribers.append(
+                Subscriber(hub, cfg["REDIS_HOST"], cfg["REDIS_PORT"], control))
+
+    def start(self):
+        for subscriber in self.subscribers:
+            subscriber.connect()
+
+    def stop(self):
+        for subscriber in self.subscribers:
+            subscriber.close()
+
+    def _subscriber(self, channel):
+        index = (zlib.crc32(channel) & 0xffffffff) % len(self.subscribers)
+        return self.subscribers[index]
+
+    def subscribe(self, channel):
+        self._subscriber(channel).subscribe(channel)
+
+    def unsubscribe(self, channel):
+        self._subscriber(channel).unsubscribe(channel)
+
+    def stats(self):
+        return dict(connections=sum(1 for s in self.subscribers if s.ready))
+
+
+class StreamBackend(object):
+    """用redis stream投递房间消息
+    消息XADD到room:<id>:stream(按MAXLEN近似裁剪), 本节点用一条连接对所有活跃房间
+    做阻塞XREAD, 每个房间记录自己的游标, 连接断开重连后从游标处批量补齐
+    """
+    name = 'stream'
+    RECONNECT_DELAY = 1
+
+    def __init__(self, hub, publisher, cfg):
+        self.hub = hub
+        self.publisher = publisher
+        self.host = cfg["REDIS_HOST"]
+        self.port = cfg["REDIS_PORT"]
+        self.block_ms = cfg.get("STREAM_BLOCK_MS", 100)
+        self.count = cfg.get("STREAM_READ_COUNT", 100)
+        self.cursors = dict()
+        self.client = None
+        self.running = False
+        self.reads = 0
+        self.entries = 0
+
+    @staticmethod
+    def stream_key(channel):
+        return channel + ":stream"
+
+    def start(self):
+        self.running = True
+        self.client = tornadoredis.Client(host=self.host, port=self.port)
+        # 本节点的私信收件stream
+        self.subscribe(self.hub.inbox)
+        self.read_loop()
+
+    def stop(self):
+        self.running = False
+        if self.client is not None:
+            self.client.disconnect()
+
+    def subscribe(self, channel):
+        # 以加入时stream的最后一条为起点, 之后发布的消息都不会漏掉
+        key = self.stream_key(channel)
+        def on_results(results):
+            if (channel != self.hub.inbox and not self.hub.rooms.get(channel)) or key in self.cursors:
+                return
+            entries = results[0] if results else None
+            if not isinstance(entries, list):
+                # 查询失败时不能从头读整个stream, 房间先不设游标, 稍后重试
+                IOLoop.current().call_later(self.RECONNECT_DELAY, self.subscribe, channel)
+                return
+            # 空列表说明stream还不存在
+            self.cursors[key] = entries[0][0] if entries else '0-0'
+        self.publisher.execute([('XREVRANGE', key, '+', '-', 'COUNT', 1)],
+                               callback=on_results)
+
+    def unsubscribe(self, channel):
+        self.cursors.pop(self.stream_key(channel), None)
+
+    @engine
+    def read_loop(self):
+        while self.running:
+            if not self.cursors:
+                yield sleep(self.block_ms / 1000.0)
+                continue
+            keys = list(self.cursors)
+            ids = [self.cursors[key] for key in keys]
+            timeout = timedelta(seconds=self.block_ms / 1000.0 + Publisher.FLUSH_TIMEOUT)
+            try:
+                reply = yield with_timeout(timeout, Task(
+                    self.client.execute_command, 'XREAD', 'COUNT', self.count,
+                    'BLOCK', self.block_ms, 'STREAMS', *(keys + ids)))
+                if isinstance(reply, ResponseError):
+                    raise reply
+            except Exception:
+                log.exception("stream read failed, reconnecting")
+                self.client.disconnect()
+                self.client = tornadoredis.Client(host=self.host, port=self.port)
+                yield sleep(self.RECONNECT_DELAY)
+                continue
+            self.reads += 1
+            for key, entries in reply or []:
+                for entry_id, fields in entries:
+                    if key not in self.cursors:
+                        # 读取期间本节点已经没人在这个房间了
+                        break
+                    self.cursors[key] = entry_id
+                    self.entries += 1
+                    self.hub.broadcast(key[:-len(":stream")], fields[1])
+
+    def stats(self):
+        return dict(connections=1 if self.running else 0,
+                    cursors=len(self.cursors), reads=self.reads, entries=self.entries)
+
+
+DELIVERY_BACKENDS = dict(pubsub=PubSubBackend, stream=StreamBackend)
+
+
+class Histogram(object):
+    """固定分桶的直方图, 分位数取所在桶的上界, 但不超过实际观测到的最大值"""
+    BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+    def __init__(self, bounds=BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, p):
+        if not self.count:
+            return 0
+        rank = self.count * p / 100.0
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+        return self.max
+
+    def stats(self):
+        buckets = dict(("le_%s" % bound, count) for bound, count in zip(self.bounds, self.counts))
+        buckets["inf"] = self.counts[-1]
+        return dict(
+            count=self.count,
+            avg=float(self.total) / self.count if self.count else 0,
+            max=self.max,
+            p50=self.percentile(50),
+            p90=self.percentile(90),
+            p99=self.percentile(99),
+            buckets=buckets,
+        )
+
+
+class Metrics(object):
+    """节点和房间两级的消息计数
+    房间的计数只在本节点还有该房间的连接时保留, 最后一个连接离开后清掉
+    """
+
+    def __init__(self):
+        self.node = Counter()
+        self.rooms = dict()
+        # 发布(on_message打的ts)到本节点分发之间的延迟, 毫秒
+        self.latency = Histogram()
+        # 每条消息分发给本节点多少个连接
+        self.fanout = Histogram()
+
+    def track(self, channel):
+        self.rooms[channel] = Counter()
+
+    def forget(self, channel):
+        self.rooms.pop(channel, None)
+
+    def incr(self, channel, name, value=1):
+        self.node[name] += value
+        room = self.rooms.get(channel)
+        if room is not None:
+            room[name] += value
+
+    def stats(self):
+        return dict(
+            counters=dict(self.node),
+            latency_ms=self.latency.stats(),
+            fanout=self.fanout.stats(),
+        )
+
+    def room_stats(self, rooms):
+        d = dict()
+        for channel, counters in self.rooms.iteritems():
+            room = dict(counters)
+            room["connections"] = len(rooms.get(channel, ()))
+            d[channel] = room
+        return d
+
+
+class RoomRegistry(object):
+    """集群范围的房间占用表
+    每个房间一个ZSET room:<id>:nodes, 成员是有该房间连接的节点, 分数是过期时间, 定期续期.
+    节点第一次有人进入房间时登记并在房间频道上广播加入通知, 最后一个人离开时注销并广播离开通知,
+    其他有该房间连接的节点据此维护房间在别的节点上的分布; 节点异常退出时靠过期和定期刷新纠正
+    """
+
+    def __init__(self, hub, publisher, ttl=60):
+        self.hub = hub
+        self.publisher = publisher
+        self.ttl = ttl
+        # 房间 -> 其他有连接的节点; ready里的房间已经读到过占用表
+        self.remote = dict()
+        self.ready = set()
+        # 刷新在途期间收到的加入通知, 刷新结果里可能还没有这些节点
+        self.joined = dict()
+        # 等待占用表读取结果的回调
+        self.waiting = dict()
+        # 发布时发现有其他节点登记但还没收到加入通知的房间, 下次刷新前按非本地处理
+        self.contended = set()
+        self.timer = None
+        self.local_published = 0
+        self.skipped_notices = 0
+
+    @staticmethod
+    def key(channel):
+        return channel + ":nodes"
+
+    def start(self):
+        self.timer = PeriodicCallback(self.refresh, self.ttl * 1000 / 3)
+        self.timer.start()
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.stop()
+
+    def is_local(self, channel):
+        """确定整个集群只有本节点有该房间的连接"""
+        return (channel in self.ready and not self.remote.get(channel)
+                and channel not in self.contended)
+
+    def join(self, channel):
+        now = time.time()
+        key = self.key(channel)
+        self.remote[channel] = set()
+        commands = [('ZADD', key, now + self.ttl, self.hub.node_id),
+                    ('EXPIRE', key, self.ttl),
+                    ('ZRANGEBYSCORE', key, now, '+inf')]
+
+        def on_results(results):
+            if channel in self.remote and results and isinstance(results[2], list):
+                remote = set(node for node in results[2] if node != self.hub.node_id)
+                self.remote[channel].update(remote)
+                self.ready.add(channel)
+                # 只有别的节点也有人时才需要通知; 两个节点同时进入时后登记的一方一定能读到先登记的
+                if remote:
+                    self.notify(channel, 'join')
+            for callback in self.waiting.pop(channel, ()):
+                callback()
+        self.publisher.execute(commands, callback=on_results)
+
+    def wait(self, channel, callback):
+        """占用表读到后(或读取失败后)再执行callback"""
+        if channel in self.ready or channel not in self.remote:
+            callback()
+        else:
+            self.waiting.setdefault(channel, []).append(callback)
+
+    def leave(self, channel):
+        local = self.is_local(channel)
+        self.remote.pop(channel, None)
+        self.ready.discard(channel)
+        self.contended.discard(channel)
+        self.waiting.pop(channel, None)
+        self.publisher.execute([('ZREM', self.key(channel), self.hub.node_id)])
+        if not local:
+            self.notify(channel, 'leave')
+
+    def notify(self, channel, action):
+        notice = encode_message(dict(type='node', data="%s %s" % (action, self.hub.node_id)))
+        self.publisher.publish(channel, notice, history=False)
+
+    def on_notice(self, channel, body):
+        action, __, node = decode_message(body).get('data', '').partition(' ')
+        remote = self.remote.get(channel)
+        if remote is None or node == self.hub.node_id:
+            return
+        if action == 'join':
+            remote.add(node)
+            if channel in self.joined:
+                self.joined[channel].add(node)
+        else:
+            remote.discard(node)
+
+    def refresh(self):
+        """续期本节点的登记, 同时重新读取各房间的占用表, 去掉已经过期的节点"""
+        channels = list(self.remote)
+        if not channels:
+            return
+        now = time.time()
+        commands = []
+        for channel in channels:
+            key = self.key(channel)
+            commands.append(('ZADD', key, now + self.ttl, self.hub.node_id))
+            commands.append(('EXPIRE', key, self.ttl))
+            commands.append(('ZREMRANGEBYSCORE', key, '-inf', now))
+            commands.append(('ZRANGEBYSCORE', key, now, '+inf'))
+        self.joined = dict((channel, set()) for channel in channels)
+
+        def on_results(results):
+            joined, self.joined = self.joined, dict()
+            if not results:
+                return
+            for i, channel in enumerate(channels):
+                nodes = results[i * 4 + 3]
+                if channel not in self.remote or not isinstance(nodes, list):
+                    continue
+                remote = set(node for node in nodes if node != self.hub.node_id)
+                self.remote[channel] = remote | joined.get(channel, set())
+                self.ready.add(channel)
+                self.contended.discard(channel)
+        self.publisher.execute(commands, callback=on_results)
+
+    def stats(self):
+        return dict(
+            rooms=len(self.remote),
+            local_rooms=sum(1 for channel in self.remote if self.is_local(channel)),
+            local_published=self.local_published,
+            skipped_notices=self.skipped_notices,
+        )
+
+
+class RoomHub(object):
+    """进程内共享的房间订阅
+    同一房间只在第一个连接加入时向投递后端订阅, 最后一个连接离开时退订,
+    收到的消息再分发给本进程内该房间的所有连接, redis连接数只和房间数相关
+    """
+
+    def __init__(self):
+        self.node_id = "%s:%d" % (socket.gethostname(), os.getpid())
+        self.inbox = "node:" + self.node_id
+        self.rooms = dict()
+        self.backend = None
+        self.publisher = None
+        self.registry = None
+        self.direct = None
+        self.metrics = Metrics()
+
+    def start(self):
+        self.backend.start()
+        if self.registry is not None:
+            self.registry.start()
+
+    def stop(self):
+        if self.registry is not None:
+            self.registry.stop()
+        self.backend.stop()
+
+    def join(self, channel, handler):
+        members = self.rooms.get(channel)
+        if members is None:
+            members = self.rooms[channel] = set()
+            self.metrics.track(channel)
+            self.backend.subscribe(channel)
+            if self.registry is not None:
+                self.registry.join(channel)
+        members.add(handler)
+        self.metrics.incr(channel, 'connections_opened')
+
+    def leave(self, channel, handler):
+        members = self.rooms.get(channel)
+        if members is None:
+            return
+        members.discard(handler)
+        self.metrics.incr(channel, 'connections_closed')
+        if not members:
+            del self.rooms[channel]
+            self.metrics.forget(channel)
+            if self.registry is not None:
+                self.registry.leave(channel)
+            self.backend.unsubscribe(channel)
+
+    def has_listeners(self, channel, handler):
+        """集群里除了handler是否还有人在房间里, 不确定时按有人处理"""
+        if len(self.rooms.get(channel, ())) > 1:
+            return True
+        if self.registry is not None:
+            return not self.registry.is_local(channel)
+        # 内存代理只服务本节点
+        return self.backend.name != MemoryBroker.name
+
+    def publish_notice(self, channel, handler, message):
+        """房间里除了handler还有别人时才发布的通知, 占用表还没读到时等读到后再判断"""
+        def publish():
+            if self.has_listeners(channel, handler):
+                self.publish(channel, message, history=False)
+            elif self.registry is not None:
+                self.registry.skipped_notices += 1
+        if self.registry is None:
+            publish()
+        else:
+            self.registry.wait(channel, publish)
+
+    def publish(self, channel, message, history=True):
+        """发布房间消息
+        确定只有本节点有该房间的连接时不走redis投递: 需要seq的消息只在redis里写历史记录,
+        拿到seq后直接在本地分发; 其他消息直接本地分发
+        """
+        if self.registry is None or not self.registry.is_local(channel):
+            self.publisher.publish(channel, message, history)
+            return
+        if history:
+            def on_append(message, delivered):
+                if delivered:
+                    # 其他节点已经登记, 消息已经投递, 本节点也会从订阅收到
+                    self.registry.contended.add(channel)
+                    return
+                self.registry.local_published += 1
+                self.broadcast(channel, message)
+            self.publisher.append(channel, message, self.node_id, on_append)
+        else:
+            self.registry.local_published += 1
+            IOLoop.current().add_callback(self.broadcast, channel, message)
+
+    def dispatch(self, msg):
+        self.broadcast(msg.channel, msg.body)
+
+    def broadcast(self, channel, body):
+        """把一条消息发给本进程内房间的所有连接
+        只看消息头部, 每种格式的帧只构造(压缩)一次, 同格式的连接写同一份bytes
+        """
+        if channel == self.inbox:
+            if self.direct is not None:
+                self.direct.deliver(utf8(body))
+            return
+        members = self.rooms.get(channel)
+        if not members:
+            return
+        body = utf8(body)
+        kind, seq, ts = message_header(body)
+        if kind == KINDS['node']:
+            if self.registry is not None:
+                self.registry.on_notice(channel, body)
+            return
+        finish = kind == KINDS['state'] and decode_message(body).get('data') == 'finish'
+        if ts and isinstance(ts, (int, long, float)):
+            self.metrics.latency.observe((time.time() - ts) * 1000)
+        self.metrics.fanout.observe(len(members))
+        self.metrics.incr(channel, 'messages_delivered')
+        frames = dict()
+        for handler in list(members):
+            codec = handler.codec()
+            item = frames.get(codec)
+            if item is None:
+                item = frames[codec] = wire_frame(body, *codec)
+            handler.send_frame(*item)
+            if finish:
+                handler.close(1000)
+
+    def stats(self):
+        d = dict(
+            rooms=len(self.rooms),
+            sockets=sum(len(members) for members in self.rooms.itervalues()),
+            backend=self.backend.name,
+            delivery=self.backend.stats(),
+        )
+        if self.registry is not None:
+            d["registry"] = self.registry.stats()
+        return d
+
+
+class Presence(object):
+    """在线状态
+    用户: HASH presence:<uid>, 字段是节点, 值是过期时间; 任一节点的登记未过期即在线.
+    房间: ZSET room:<id>:online, 成员是uid@节点, 分数是过期时间.
+    连接进出只修改本节点的计数并记下变化, 每flush_interval秒把净变化合成一个pipeline写出,
+    重连风暴里同一个用户的断开和连接会相互抵消; 每ttl/3秒续期一次本节点的全部登记,
+    心跳回收掉的半开连接会随之离线, 节点异常退出时登记在ttl后过期.
+    local为True时(内存代理)只统计本节点
+    """
+    MAX_IDS = 500
+
+    def __init__(self, hub, publisher, ttl=90, flush_interval=1, local=False):
+        self.hub = hub
+        self.publisher = publisher
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.local = local
+        self.users = Counter()
+        self.members = Counter()
+        self.dirty_users = set()
+        self.dirty_members = set()
+        # redis里已有本节点登记的用户
+        self.registered = set()
+        self.timers = []
+        self.flushes = 0
+        self.writes = 0
+
+    @staticmethod
+    def user_key(uid):
+        return "presence:%s" % uid
+
+    @staticmethod
+    def room_key(channel):
+        return channel + ":online"
+
+    def start(self):
+        if self.local:
+            return
+        self.timers = [PeriodicCallback(self.flush, self.flush_interval * 1000),
+                       PeriodicCallback(self.refresh, self.ttl * 1000 / 3)]
+        for timer in self.timers:
+            timer.start()
+
+    def stop(self):
+        for timer in self.timers:
+            timer.stop()
+        self.timers = []
+
+    def join(self, channel, uid):
+        self.users[uid] += 1
+        self.members[(channel, uid)] += 1
+        # 只统计本节点时没有flush, 记下的变化永远不会被清空
+        if not self.local:
+            self.dirty_users.add(uid)
+            self.dirty_members.add((channel, uid))
+
+    def leave(self, channel, uid):
+        for counter, key in ((self.users, uid), (self.members, (channel, uid))):
+            counter[key] -= 1
+            if counter[key] <= 0:
+                del counter[key]
+        if not self.local:
+            self.dirty_users.add(uid)
+            self.dirty_members.add((channel, uid))
+
+    def refresh(self):
+        self.dirty_users.update(self.users)
+        self.dirty_members.update(self.members)
+        for channel in set(channel for channel, uid in self.members):
+            self.publisher.execute([('ZREMRANGEBYSCORE', self.room_key(channel), '-inf', time.time())])
+
+    def flush(self):
+        if not self.dirty_users and not self.dirty_members:
+            return
+        expire = time.time() + self.ttl
+        node = self.hub.node_id
+        commands = []
+        for uid in self.dirty_users:
+            key = self.user_key(uid)
+            if uid in self.users:
+                commands.append(('HSET', key, node, expire))
+                commands.append(('EXPIRE', key, self.ttl))
+                self.registered.add(uid)
+            else:
+                commands.append(('HDEL', key, node))
+                self.registered.discard(uid)
+        for channel, uid in self.dirty_members:
+            key = self.room_key(channel)
+            member = "%s@%s" % (uid, node)
+            if (channel, uid) in self.members:
+                commands.append(('ZADD', key, expire, member))
+                commands.append(('EXPIRE', key, self.ttl))
+            else:
+                commands.append(('ZREM', key, member))
+        self.dirty_users = set()
+        self.dirty_members = set()
+        self.flushes += 1
+        self.writes += len(commands)
+        self.publisher.execute(commands)
+
+    def register(self, uid, callback):
+        """立即登记用户在本节点上线, 不等合并写入; callback收到取出的离线私信"""
+        self.registered.add(uid)
+        keys = (self.user_key(uid), DirectRouter.backlog_key(uid))
+        args = (self.hub.node_id, time.time() + self.ttl, self.ttl)
+        def on_results(results):
+            backlog = results[0] if results else None
+            callback(backlog if isinstance(backlog, list) else [])
+        self.publisher.execute([REGISTER_SCRIPT.command(keys, args)], callback=on_results)
+
+    def room_counts(self, channels, callback):
+        """各房间的在线人数"""
+        if self.local:
+            counts = Counter(channel for channel, uid in self.members)
+            callback([counts[channel] for channel in channels])
+            return
+        now = time.time()
+        def on_results(results):
+            callback([count if isinstance(count, (int, long)) else None
+                      for count in results] if results else [None] * len(channels))
+        self.publisher.execute([('ZCOUNT', self.room_key(channel), now, '+inf')
+                                for channel in channels], callback=on_results)
+
+    def online(self, uids, callback):
+        """uids中每个用户是否在线"""
+        if self.local:
+            callback([uid in self.users for uid in uids])
+            return
+        def on_results(results):
+            flags = results[0] if results else None
+            callback([bool(flag) for flag in flags] if isinstance(flags, list) else None)
+        keys = [self.user_key(uid) for uid in uids]
+        self.publisher.execute([ONLINE_SCRIPT.command(keys, (time.time(),))], callback=on_results)
+
+    def room_members(self, channel, callback):
+        """房间里在线的uid列表"""
+        if self.local:
+            callback(sorted(uid for room, uid in self.members if room == channel))
+            return
+        def on_results(results):
+            members = results[0] if results else None
+            if not isinstance(members, list):
+                callback(None)
+                return
+            callback(sorted(set(member.rpartition('@')[0] for member in members)))
+        self.publisher.execute([('ZRANGEBYSCORE', self.room_key(channel), time.time(), '+inf')],
+                               callback=on_results)
+
+    def stats(self):
+        return dict(
+            users=len(self.users),
+            members=len(self.members),
+            pending=len(self.dirty_users) + len(self.dirty_members),
+            flushes=self.flushes,
+            writes=self.writes,
+        )
+
+
+class DirectRouter(object):
+    """私信
+    在线状态presence:<uid>兼作路由表, 私信由DIRECT_SCRIPT只发布到接收者所在节点的收件频道
+    (node:<node_id>, stream投递时是node:<node_id>:stream), 节点再转给本地该用户的所有连接,
+    不需要为每个用户建频道. 接收者不在线时写入backlog:<uid>, 用户在一个节点上首次连接时
+    随登记一起取出, 一次写给该连接. local为True时(内存代理)路由和离线私信都在本进程内.
+    require_friends为True时只能发给friends:<uid>集合里的用户, 这个集合由API按Usership维护,
+    内存代理没有redis无法校验, 此时私信一律拒绝
+    """
+    NOT_FRIENDS_MSG = encode_message(dict(type='error', data='not friends'))
+
+    def __init__(self, hub, publisher, presence, delivery='pubsub', backlog_size=100,
+                 backlog_ttl=604800, stream_maxlen=1000, local=False, require_friends=True):
+        self.hub = hub
+        self.publisher = publisher
+        self.presence = presence
+        self.delivery = delivery
+        self.backlog_size = backlog_size
+        self.backlog_ttl = backlog_ttl
+        self.stream_maxlen = stream_maxlen
+        self.local = local
+        self.require_friends = require_friends
+        self.users = dict()
+        self.backlogs = dict()
+        self.sent = 0
+        self.delivered = 0
+        self.backlogged = 0
+        self.rejected = 0
+
+    @staticmethod
+    def backlog_key(uid):
+        return "backlog:%s" % uid
+
+    @staticmethod
+    def friends_key(uid):
+        return "friends:%s" % uid
+
+    def connect(self, handler):
+        uid = handler.uid
+        handlers = self.users.get(uid)
+        first = handlers is None
+        if first:
+            handlers = self.users[uid] = set()
+        handlers.add(handler)
+        if self.local:
+            backlog = self.backlogs.pop(uid, None)
+            if backlog:
+                IOLoop.current().add_callback(self.flush_backlog, handler, list(backlog))
+        elif first:
+            # 按本节点是否已有该用户的连接判断, 不能看presence.registered: 它到下次flush才清除,
+            # 断开后在flush之前写入的离线私信会在快速重连时漏取
+            self.presence.register(uid, lambda backlog: self.flush_backlog(handler, backlog))
+
+    def disconnect(self, handler):
+        handlers = self.users.get(handler.uid)
+        if handlers is None:
+            return
+        handlers.discard(handler)
+        if not handlers:
+            del self.users[handler.uid]
+
+    def flush_backlog(self, handler, backlog):
+        if not backlog:
+            return
+        codec = handler.codec()
+        handler.send_frames([wire_frame(envelope.partition('|')[2], *codec)
+                             for envelope in backlog])
+
+    def reject(self, handler):
+        self.rejected += 1
+        if handler.ws_connection is not None:
+            handler.send_frame(*wire_frame(self.NOT_FRIENDS_MSG, *handler.codec()))
+
+    def send(self, handler, to, data):
+        sender = handler.uid
+        message = encode_message(dict(type='direct', data=data, ts=time.time(),
+                                      **{'from': sender, 'to': to}))
+        envelope = "%s|%s" % (to, message)
+        if self.local:
+            if self.require_friends:
+                self.reject(handler)
+                return
+            self.sent += 1
+            if to in self.users:
+                IOLoop.current().add_callback(self.deliver, envelope)
+            else:
+                backlog = self.backlogs.get(to)
+                if backlog is None:
+                    backlog = self.backlogs[to] = deque(maxlen=self.backlog_size)
+                backlog.append(envelope)
+                self.backlogged += 1
+            return
+        def on_results(results):
+            if not results:
+                return
+            if results[0] == -1:
+                self.reject(handler)
+                return
+            self.sent += 1
+            if results[0] == 0:
+                self.backlogged += 1
+        keys = (Presence.user_key(to), self.backlog_key(to), self.friends_key(sender))
+        args = (envelope, time.time(), self.delivery, self.backlog_size, self.backlog_ttl,
+                self.stream_maxlen, to, int(self.require_friends))
+        self.publisher.execute([DIRECT_SCRIPT.command(keys, args)], callback=on_results)
+
+    def deliver(self, envelope):
+        """收件频道上的私信转给本地接收者的连接"""
+        to, __, message = envelope.partition('|')
+        handlers = self.users.get(to)
+        if not handlers:
+            # 投递途中接收者已经离开本节点, 其他节点都没有接收者时转为离线私信
+            if self.local:
+                self.backlogs.setdefault(to, deque(maxlen=self.backlog_size)).append(envelope)
+                self.backlogged += 1
+                return
+            def on_results(results):
+                if results and results[0] == 1:
+                    self.backlogged += 1
+            keys = (Presence.user_key(to), self.backlog_key(to))
+            args = (envelope, time.time(), self.hub.node_id, self.backlog_size, self.backlog_ttl)
+            self.publisher.execute([BACKLOG_SCRIPT.command(keys, args)], callback=on_results)
+            return
+        self.delivered += 1
+        frames = dict()
+        for handler in list(handlers):
+            codec = handler.codec()
+            if codec not in frames:
+                frames[codec] = wire_frame(message, *codec)
+            handler.send_frame(*frames[codec])
+
+    def stats(self):
+        return dict(
+            users=len(self.users),
+            sent=self.sent,
+            delivered=self.delivered,
+            backlogged=self.backlogged,
+            rejected=self.rejected,
+        )
+
+
+class HeartbeatWheel(object):
+    """进程内唯一的心跳时间轮
+    每个连接按下一次检查的时间挂在一个槽上, 定时器每个tick只处理当前槽:
+    等待pong的连接到期仍没收到pong就回收, 其余的检查空闲时间后发ping并挂到pong期限的槽上.
+    每个tick的开销只和该槽上的连接数有关, 不需要给每个连接注册定时器
+    """
+
+    def __init__(self, ping_interval=30, pong_timeout=10, idle_timeout=0, tick=1):
+        self.tick = tick
+        self.pong_timeout = min(pong_timeout, ping_interval)
+        self.ping_delay = max(ping_interval - self.pong_timeout, tick)
+        self.idle_timeout = idle_timeout
+        size = int(max(self.ping_delay, self.pong_timeout) / tick) + 2
+        self.slots = [set() for _ in range(size)]
+        self.current = 0
+        self.timer = None
+        self.pings = 0
+        self.reaped = 0
+        self.idle_reaped = 0
+
+    def start(self):
+        self.timer = PeriodicCallback(self.on_tick, self.tick * 1000)
+        self.timer.start()
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.stop()
+
+    def _schedule(self, handler, delay):
+        index = (self.current + max(1, int(delay / self.tick))) % len(self.slots)
+        self.slots[index].add(handler)
+        handler.heartbeat_slot = index
+
+    def add(self, handler):
+        handler.awaiting_pong = False
+        handler.ping_sent = 0
+        self._schedule(handler, self.ping_delay)
+
+    def remove(self, handler):
+        slot = handler.heartbeat_slot
+        if slot is not None:
+            self.slots[slot].discard(handler)
+            handler.heartbeat_slot = None
+
+    def on_tick(self):
+        self.current = (self.current + 1) % len(self.slots)
+        due = self.slots[self.current]
+        if not due:
+            return
+        self.slots[self.current] = set()
+        now = time.time()
+        for handler in due:
+            handler.heartbeat_slot = None
+            conn = handler.ws_connection
+            if conn is None:
+                continue
+            if handler.awaiting_pong:
+                # pong期限内没有回应, 多半是已经断了信号的半开连接, 直接断开
+                self.reaped += 1
+                conn._abort()
+                continue
+            if handler.ping_sent:
+                # 按时收到了pong, 到ping间隔再检查
+                handler.ping_sent = 0
+                self._schedule(handler, self.ping_delay)
+                continue
+            if self.idle_timeout and now - handler.last_active > self.idle_timeout:
+                self.idle_reaped += 1
+                handler.close(1000, "idle timeout")
+                continue
+            handler.awaiting_pong = True
+            handler.ping_sent = now
+            self.pings += 1
+            try:
+                handler.ping(b"")
+            except WebSocketClosedError:
+                continue
+            self._schedule(handler, self.pong_timeout)
+
+    def on_pong(self, handler):
+        handler.awaiting_pong = False
+
+    def stats(self):
+        return dict(
+            connections=sum(len(slot) for slot in self.slots),
+            pings=self.pings,
+            reaped=self.reaped,
+            idle_reaped=self.idle_reaped,
+        )
+
+
+class StallWatchdog(object):
+    """IOLoop阻塞检测
+    借助tornado的set_blocking_signal_threshold, 单次回调执行超过threshold秒时由SIGALRM
+    取到当时的堆栈, 按堆栈在最近samples个样本里计数, 热点从metrics接口查看.
+    只在每轮IOLoop设置/取消一次定时器, 可以在线上常开
+    """
+    DEPTH = 8
+
+    def __init__(self, threshold=0, samples=1000):
+        self.threshold = threshold
+        self.recent = deque(maxlen=samples)
+        self.offenders = Counter()
+        self.stalls = 0
+
+    def start(self):
+        if self.threshold:
+            IOLoop.current().set_blocking_signal_threshold(self.threshold, self.on_stall)
+
+    def stop(self):
+        if self.threshold:
+            IOLoop.current().set_blocking_signal_threshold(None, None)
+
+    def on_stall(self, signum, frame):
+        stack = tuple(traceback.extract_stack(frame)[-self.DEPTH:])
+        self.stalls += 1
+        if len(self.recent) == self.recent.maxlen:
+            old = self.recent[0]
+            self.offenders[old] -= 1
+            if not self.offenders[old]:
+                del self.offenders[old]
+        self.recent.append(stack)
+        self.offenders[stack] += 1
+        if self.offenders[stack] == 1:
+            log.warning("IOLoop blocked for more than %ss:\n%s", self.threshold,
+                        "".join(traceback.format_list(stack)))
+        else:
+            filename, lineno, name, __ = stack[-1]
+            log.warning("IOLoop blocked for more than %ss at %s:%d in %s (%d times)",
+                        self.threshold, filename, lineno, name, self.offenders[stack])
+
+    def stats(self, top=10):
+        return dict(
+            threshold=self.threshold,
+            stalls=self.stalls,
+            top=[dict(count=count, stack=["%s:%d in %s" % (filename, lineno, name)
+                                          for filename, lineno, name, __ in stack])
+                 for stack, count in self.offenders.most_common(top)],
+        )
+
+
+class TokenBucket(object):
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.stamp = time.time()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def consume(self, now):
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def full(self, now):
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class RateLimiter(object):
+    """消息限流
+    每个连接一个本地令牌桶; 房间和用户的令牌桶在本节点内共享, 并定期把本节点的用量
+    批量INCRBY到redis的窗口计数上, 集群总用量超出窗口预算的房间/用户在窗口结束前直接拒绝.
+    判断都在本地完成, 被拒绝的消息不会产生任何redis操作.
+    用户限流只按令牌校验过的uid计数, 匿名连接只受连接和房间限流, 否则冒用别人的uid就能
+    耗尽对方的额度, 让对方在整个集群被拒绝
+    """
+
+    def __init__(self, publisher, cfg):
+        self.publisher = publisher
+        self.conn_limit = (cfg.get("RATE_CONN_RATE", 5), cfg.get("RATE_CONN_BURST", 10))
+        self.limits = dict(
+            room=(cfg.get("RATE_ROOM_RATE", 50), cfg.get("RATE_ROOM_BURST", 100)),
+            user=(cfg.get("RATE_USER_RATE", 5), cfg.get("RATE_USER_BURST", 10)),
+        )
+        self.window = cfg.get("RATE_WINDOW", 10)
+        self.buckets = dict()
+        self.usage = Counter()
+        self.blocked = dict()
+        self.rejected = Counter()
+        self.timer = None
+
+    def start(self):
+        self.timer = PeriodicCallback(self.sync, 1000)
+        self.timer.start()
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.stop()
+
+    def connection_bucket(self):
+        rate, burst = self.conn_limit
+        return TokenBucket(rate, burst) if rate else None
+
+    def allow(self, handler):
+        now = time.time()
+        if handler.bucket is not None and not handler.bucket.consume(now):
+            self.rejected['connection'] += 1
+            return False
+        window = int(now // self.window)
+        keys = [('room', handler.room_id)]
+        # handler.uid只来自校验过的令牌
+        if handler.uid:
+            keys.append(('user', handler.uid))
+        for key in keys:
+            rate, burst = self.limits[key[0]]
+            if not rate:
+                continue
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = TokenBucket(rate, burst)
+            if self.blocked.get(key) == window or not bucket.consume(now):
+                self.rejected[key[0]] += 1
+                return False
+            self.usage[key] += 1
+        return True
+
+    def sync(self):
+        now = time.time()
+        window = int(now // self.window)
+        usage, self.usage = self.usage, Counter()
+        if usage:
+            keys = list(usage)
+            commands = []
+            for kind, oid in keys:
+                key = "ratelimit:%s:%s:%d" % (kind, oid, window)
+                commands.append(('INCRBY', key, usage[(kind, oid)]))
+                commands.append(('EXPIRE', key, self.window * 2))
+
+            def on_results(results):
+                if not results:
+                    return
+                for i, key in enumerate(keys):
+                    total = results[i * 2]
+                    rate, burst = self.limits[key[0]]
+                    if isinstance(total, (int, long)) and total >= rate * self.window + burst:
+                        self.blocked[key] = window
+            self.publisher.execute(commands, callback=on_results)
+
+        # 回收已经回满且没有被封禁的桶
+        for key, bucket in self.buckets.items():
+            if key not in usage and bucket.full(now):
+                del self.buckets[key]
+        for key, blocked in self.blocked.items():
+            if blocked != window:
+                del self.blocked[key]
+
+    def stats(self):
+        return dict(
+            rejected=dict(self.rejected),
+            buckets=len(self.buckets),
+            blocked=len(self.blocked),
+        )
+
+
+class Publisher(object):
+    """异步批量读写redis
+    publish/history只把命令放进队列, 下一轮IOLoop把积压的命令合成一个pipeline发出去,
+    同一时间只有一个pipeline在途, 期间到达的命令进入下一批
+    """
+    FLUSH_TIMEOUT = 5
+    SCRIPTS = (APPEND_SCRIPT, RESUME_SCRIPT, ONLINE_SCRIPT, REGISTER_SCRIPT, DIRECT_SCRIPT,
+               BACKLOG_SCRIPT)
+
+    def __init__(self, host, port, max_queue=10000, history_size=100,
+                 delivery='pubsub', stream_maxlen=1000):
+        self.host = host
+        self.port = port
+        self.max_queue = max_queue
+        self.history_size = history_size
+        self.delivery = delivery
+        self.stream_maxlen = stream_maxlen
+        self.client = None
+        self.queue = deque()
+        self.scheduled = False
+        self.flushing = False
+        self.scripts_loaded = False
+        # 统计
+        self.published = 0
+        self.dropped = 0
+        self.errors = 0
+        self.batches = 0
+        self.max_depth = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+
+    def start(self):
+        # 连接在第一次flush时建立, 之后一直复用
+        self.client = tornadoredis.Client(host=self.host, port=self.port)
+
+    def stop(self):
+        if self.client is not None:
+            self.client.disconnect()
+            self.client = None
+        self.scripts_loaded = False
+
+    def publish(self, channel, message, history=True):
+        """发布一条房间消息
+        history为True时由redis分配seq并追加到房间的定长历史记录, 否则只发布不编号
+        """
+        target = channel
+        if self.delivery == StreamBackend.name:
+            target = StreamBackend.stream_key(channel)
+        if history:
+            keys = (channel + ":seq", channel + ":history", target)
+            args = (message, self.history_size, self.delivery, self.stream_maxlen)
+            command = APPEND_SCRIPT.command(keys, args)
+        elif target != channel:
+            command = ('XADD', target, 'MAXLEN', '~', self.stream_maxlen, '*', 'm', message)
+        else:
+            command = ('PUBLISH', channel, message)
+        self.execute([command])
+
+    def append(self, channel, message, node_id, callback):
+        """分配seq并写入历史记录, 房间占用表里没有其他节点时不投递,
+        callback(带seq的消息, 是否已投递); 失败时不回调"""
+        target = channel
+        if self.delivery == StreamBackend.name:
+            target = StreamBackend.stream_key(channel)
+        keys = (channel + ":seq", channel + ":history", target, RoomRegistry.key(channel))
+        args = (message, self.history_size, self.delivery, self.stream_maxlen,
+                node_id, time.time())
+        def on_results(results):
+            result = results[0] if results else None
+            if isinstance(result, list) and len(result) == 2:
+                seq, delivered = result
+                callback('%s%012d%s' % (message[:1], seq, message[13:]), bool(delivered))
+        self.execute([APPEND_SCRIPT.command(keys, args)], callback=on_results)
+
+    def history(self, channel, count, callback):
+        """读取房间最近count条历史记录, 与同一批的发布共用一个pipeline"""
+        key = channel + ":history"
+        def on_results(results):
+            messages = results[0] if results else None
+            callback(messages if isinstance(messages, list) else [])
+        self.execute([('LRANGE', key, -count, -1)], callback=on_results)
+
+    def resume(self, channel, since, callback):
+        """读取seq大于since的历史记录, callback(messages, last_seq)
+        记录已被裁掉时messages少于last_seq - since条
+        """
+        keys = (channel + ":seq", channel + ":history")
+        def on_results(results):
+            result = results[0] if results else None
+            if not isinstance(result, list):
+                callback([], None)
+                return
+            callback(result[1], result[0])
+        self.execute([RESUME_SCRIPT.command(keys, (since,))], callback=on_results)
+
+    def execute(self, commands, callback=None):
+        """commands是(cmd, *args)的列表, callback收到各命令的结果, 失败或被丢弃时收到None"""
+        if len(self.queue) >= self.max_queue:
+            # redis跟不上时丢弃最旧的命令, 不让队列无限增长
+            __, dropped_callback = self.queue.popleft()
+            self.dropped += 1
+            if dropped_callback is not None:
+                dropped_callback(None)
+        self.queue.append((commands, callback))
+        self.max_depth = max(self.max_depth, len(self.queue))
+        self._schedule()
+
+    def _schedule(self):
+        if not self.scheduled and not self.flushing:
+            self.scheduled = True
+            IOLoop.current().add_callback(self.flush)
+
+    @engine
+    def flush(self):
+        self.scheduled = False
+        if self.flushing or not self.queue:
+            return
+        self.flushing = True
+        batch, self.queue = self.queue, deque()
+        pipe = self.client.pipeline()
+        # 新连接或redis重启后先加载脚本, 之后都走EVALSHA
+        preload = 0 if self.scripts_loaded else len(self.SCRIPTS)
+        for script in self.SCRIPTS[:preload]:
+            pipe.execute_command('SCRIPT', 'LOAD', script.source)
+        for commands, callback in batch:
+            for command in commands:
+                pipe.execute_command(*command)
+        start = time.time()
+        results = None
+        try:
+            results = yield with_timeout(timedelta(seconds=self.FLUSH_TIMEOUT),
+                                         Task(pipe.execute))
+        except Exception as e:
+            self.errors += 1
+            self.dropped += len(batch)
+            if isinstance(e, TimeoutError):
+                log.error("redis flush timed out, %d commands lost", len(batch))
+            else:
+                log.exception("redis flush failed, %d commands lost", len(batch))
+            # pipeline的状态已不可信, 换一条新连接
+            self.stop()
+            self.start()
+        else:
+            self.published += len(batch)
+            self.scripts_loaded = True
+            results = results[preload:]
+        latency = time.time() - start
+        self.batches += 1
+        self.last_latency = latency
+        self.max_latency = max(self.max_latency, latency)
+        self.total_latency += latency
+        self.flushing = False
+        if self.queue:
+            self._schedule()
+
+        offset = 0
+        retry = []
+        for commands, callback in batch:
+            replies = results[offset:offset + len(commands)] if results else None
+            offset += len(commands)
+            if replies and any(isinstance(r, ResponseError) and 'NOSCRIPT' in r.message
+                               for r in replies):
+                # 脚本缓存被清空(redis重启或SCRIPT FLUSH), 重新加载后再执行一次
+                self.scripts_loaded = False
+                retry.append((commands, callback))
+            elif callback is not None:
+                callback(replies)
+        if retry:
+            self.queue.extendleft(reversed(retry))
+            self._schedule()
+
+    def pending(self):
+        return bool(self.queue) or self.flushing
+
+    def stats(self):
+        return dict(
+            queue_depth=len(self.queue),
+            max_queue_depth=self.max_depth,
+            published=self.published,
+            dropped=self.dropped,
+            errors=self.errors,
+            batches=self.batches,
+            last_flush_latency=self.last_latency,
+            max_flush_latency=self.max_latency,
+            avg_flush_latency=self.total_latency / self.batches if self.batches else 0.0,
+        )
+
+
+class MemoryBroker(object):
+    """进程内的消息代理, 同时充当Publisher和投递后端
+    单机部署时所有订阅者都在本进程里, seq和定长历史记录保存在内存中,
+    发布直接分发给本地房间成员, 不需要redis. 也用于集成测试和压测
+    """
+    name = 'memory'
+
+    def __init__(self, hub, cfg):
+        self.hub = hub
+        self.history_size = cfg.get("HISTORY_SIZE", 100)
+        self.seqs = Counter()
+        self.histories = dict()
+        self.published = 0
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def subscribe(self, channel):
+        pass
+
+    def unsubscribe(self, channel):
+        pass
+
+    def publish(self, channel, message, history=True):
+        if history:
+            self.seqs[channel] += 1
+            message = '%s%012d%s' % (message[:1], self.seqs[channel], message[13:])
+            messages = self.histories.get(channel)
+            if messages is None:
+                messages = self.histories[channel] = deque(maxlen=self.history_size)
+            messages.append(message)
+        self.published += 1
+        # 和走redis时一样在下一轮IOLoop投递
+        IOLoop.current().add_callback(self.hub.broadcast, channel, message)
+
+    def history(self, channel, count, callback):
+        messages = list(self.histories.get(channel, ()))[-count:]
+        IOLoop.current().add_callback(callback, messages)
+
+    def resume(self, channel, since, callback):
+        last = self.seqs[channel]
+        count = last - since
+        messages = list(self.histories.get(channel, ()))[-count:] if count > 0 else []
+        IOLoop.current().add_callback(callback, messages, last)
+
+    def execute(self, commands, callback=None):
+        # 没有集群共享状态, 需要redis的操作直接当作失败
+        if callback is not None:
+            IOLoop.current().add_callback(callback, None)
+
+    def pending(self):
+        return False
+
+    def stats(self):
+        return dict(published=self.published, rooms=len(self.histories))
+
+
+class RoomDemo(WebSocketHandler):
+    FINISH_MSG = encode_message(dict(type='state', data='finish'))
+    RATE_LIMITED_MSG = encode_message(dict(type='error', data='rate limited'))
+    INVALID_DIRECT_MSG = encode_message(dict(type='error', data='invalid direct message'))
+
+    # 客户端通过Sec-WebSocket-Protocol选择消息格式, 不指定时用json
+    JSON_PROTOCOL = 'pigroom.json'
+    BINARY_PROTOCOL = 'pigroom.bin'
+
+    # 慢连接处理策略
+    DROP_OLDEST = 'drop_oldest'
+    COLLAPSE = 'collapse'
+    DISCONNECT = 'disconnect'
+
+    # 节点级出队列统计
+    outbox_high_water = 0
+    outbox_dropped = 0
+    outbox_collapsed = 0
+    slow_disconnected = 0
+
+    def initialize(self, hub, publisher, heartbeat, limiter, presence, deflater=None, **kws):
+        self.hub = hub
+        self.publisher = publisher
+        self.heartbeat = heartbeat
+        self.limiter = limiter
+        self.presence = presence
+        self.direct = hub.direct
+        self.token_secret = kws.get("CHAT_TOKEN_SECRET")
+        self.compression = dict(deflater=deflater) if deflater is not None else None
+        self.deflater = None
+        self.bucket = limiter.connection_bucket()
+        self.uid = None
+        self.heartbeat_slot = None
+        self.awaiting_pong = False
+        self.ping_sent = 0
+        self.last_active = time.time()
+        self.channels = None
+        self.outbox = deque()
+        self.outbox_size = kws.get("OUTBOX_SIZE", 256)
+        self.outbox_policy = kws.get("OUTBOX_POLICY", self.DROP_OLDEST)
+        self.outbox_close_code = kws.get("OUTBOX_CLOSE_CODE", 1013)
+        self.missed = 0
+        self.draining = False
+        self.replay_size = kws.get("REPLAY_SIZE", 20)
+        self.replaying = False
+        self.binary = False
+
+    def get_compression_options(self):
+        return self.compression
+
+    def get_websocket_protocol(self):
+        websocket_version = self.request.headers.get("Sec-WebSocket-Version")
+        if websocket_version in ("7", "8", "13"):
+            return DeflateProtocol(self, compression_options=self.get_compression_options())
+
+    def codec(self):
+        """决定帧格式的协商结果"""
+        return self.binary, self.deflater
+
+    def select_subprotocol(self, subprotocols):
+        for protocol in subprotocols:
+            if protocol in (self.JSON_PROTOCOL, self.BINARY_PROTOCOL):
+                self.binary = protocol == self.BINARY_PROTOCOL
+                return protocol
+        return None
 
     def open(self, room_id, *args, **kws):
         self.channels = "room:" + str(room_id)
         self.room_id = room_id
-        self.listen(self.channels)
+        # 只认API签发的令牌里的uid, 没有有效令牌的连接是匿名的: 可以在房间里聊天,
+        # 但不登记在线状态, 不能收发私信, 也不按用户限流
+        self.uid = verify_token(self.get_argument("token", None), self.token_secret)
+        if self.uid:
+            self.presence.join(self.channels, self.uid)
+            self.direct.connect(self)
+        self.heartbeat.add(self)
+        # 回放历史期间到达的实时消息先留在出队列里
+        self.replaying = bool(self.replay_size)
+        self.hub.join(self.channels, self)
+        since = self.get_argument("since", None)
+        if since is not None and since.isdigit():
+            # 断线重连的客户端只补发since之后缺失的消息
+            self.replaying = True
+            self.publisher.resume(self.channels, int(since), self.on_resume)
+        elif self.replaying:
+            self.publisher.history(self.channels, self.replay_size, self.on_history)
         d = dict(type='message', data="another one come in!!!")
         channel = "room:" + str(self.room_id)
-        RedisDB.publish(channel, json.dumps(d))
+        self.hub.publish_notice(channel, self, encode_message(d))
+
+    def on_resume(self, messages, last_seq):
+        since = int(self.get_argument("since"))
+        reset = None
+        if last_seq is not None and (last_seq < since or len(messages) < last_seq - since):
+            # 缺口超出了保留的历史(或seq被重置), 让客户端自己重新拉取全部记录
+            reset = encode_message(dict(type='state', data='reset', seq=last_seq))
+        self.on_history(messages, reset)
+
+    def on_history(self, messages, notice=None):
+        """历史记录和回放期间缓存的实时消息合并成一次写出, 按seq去掉重复的实时消息"""
+        self.replaying = False
+        conn = self.ws_connection
+        if conn is None:
+            return
+        items = []
+        if notice is not None:
+            items.append(wire_frame(notice, *self.codec()))
+        last_seq = 0
+        for message in messages:
+            message = utf8(message)
+            last_seq = max(last_seq, message_header(message)[1])
+            items.append(wire_frame(message, *self.codec()))
+        for frame, payload in self.outbox:
+            seq = message_header(payload)[1]
+            if not seq or seq > last_seq:
+                items.append((frame, payload))
+        self.outbox.clear()
+        if items:
+            self._write(conn, items)
 
     def on_message(self, message):
-        d = dict(type='message', data=message)
+        self.last_active = time.time()
+        if isinstance(message, bytes):
+            # 二进制帧的内容也按utf-8文本处理
+            try:
+                message = message.decode('utf-8')
+            except UnicodeDecodeError:
+                return
+        metrics = self.hub.metrics
+        if not self.limiter.allow(self):
+            metrics.incr(self.channels, 'messages_rejected')
+            self.send_frame(*wire_frame(self.RATE_LIMITED_MSG, *self.codec()))
+            return
+        if message[:1] == '{':
+            # 私信: {"type": "direct", "to": "<uid>", "data": "..."}
+            d = parse_message(message)
+            if d.get('type') == 'direct':
+                to, data = d.get('to'), d.get('data')
+                if not self.uid or not unicode(to).isdigit() or not isinstance(data, basestring):
+                    self.send_frame(*wire_frame(self.INVALID_DIRECT_MSG, *self.codec()))
+                    return
+                self.direct.send(self, str(to), data)
+                return
+        metrics.incr(self.channels, 'messages_in')
+        # ts用于统计发布到投递的延迟
+        d = dict(type='message', data=message, ts=time.time())
         channel = "room:" + str(self.room_id)
-        RedisDB.publish(channel, json.dumps(d))
+        self.hub.publish(channel, encode_message(d))
 
-    def on_subscribe(self, msg):
-        if msg.kind == 'message':
-            self.write_message(msg.body)
-            if "finish" in msg and "state" in msg:
-                self.close(1000)
-        elif msg.kind == 'disconnect':
-            self.close(1011)
+    def send_frame(self, frame, payload):
+        """发送一条已组好帧的消息
+        tornado的写缓冲里还有数据时先进入有界的出队列, 等缓冲写空后再合并写出,
+        队列满了按outbox_policy处理慢连接
+        """
+        conn = self.ws_connection
+        if conn is None:
+            return
+        if self.replaying or self.outbox or conn.stream.writing():
+            self._enqueue(frame, payload)
+            return
+        self._write(conn, [(frame, payload)])
+
+    def send_frames(self, items):
+        """一次写出多条已组好帧的消息"""
+        conn = self.ws_connection
+        if conn is None:
+            return
+        if self.replaying or self.outbox or conn.stream.writing():
+            for frame, payload in items:
+                self._enqueue(frame, payload)
+            return
+        self._write(conn, items)
+
+    def _enqueue(self, frame, payload):
+        if len(self.outbox) >= self.outbox_size:
+            if self.outbox_policy == self.DISCONNECT:
+                RoomDemo.slow_disconnected += 1
+                self.hub.metrics.incr(self.channels, 'frames_dropped', len(self.outbox))
+                self.outbox.clear()
+                self.close(self.outbox_close_code, "slow consumer")
+                return
+            elif self.outbox_policy == self.COLLAPSE:
+                RoomDemo.outbox_collapsed += len(self.outbox)
+                self.hub.metrics.incr(self.channels, 'frames_dropped', len(self.outbox))
+                self.missed += len(self.outbox)
+                self.outbox.clear()
+            else:
+                RoomDemo.outbox_dropped += 1
+                self.hub.metrics.incr(self.channels, 'frames_dropped')
+                self.outbox.popleft()
+        self.outbox.append((frame, payload))
+        RoomDemo.outbox_high_water = max(RoomDemo.outbox_high_water, len(self.outbox))
+        if not self.draining and not self.replaying:
+            # 写缓冲里可能是tornado自己写的ping/pong/close帧, 没有经过_write注册写空回调,
+            # 不补上的话出队列再也不会写出
+            self.draining = True
+            conn = self.ws_connection
+            try:
+                conn.stream.write(b"", callback=self._drain)
+            except StreamClosedError:
+                conn._abort()
+
+    def _write(self, conn, items):
+        stream = conn.stream
+        try:
+            data = b"".join(frame for frame, payload in items)
+            stream.write(data)
+            metrics = self.hub.metrics
+            metrics.incr(self.channels, 'messages_out', len(items))
+            metrics.incr(self.channels, 'bytes_out', len(data))
+            if stream.writing() and not self.draining:
+                self.draining = True
+                stream.write(b"", callback=self._drain)
+        except StreamClosedError:
+            conn._abort()
+
+    def _drain(self):
+        self.draining = False
+        conn = self.ws_connection
+        if conn is None:
+            self.outbox.clear()
+            return
+        if self.replaying:
+            return
+        items = list(self.outbox)
+        self.outbox.clear()
+        if self.missed:
+            notice = encode_message(dict(type='state', data='missed', count=self.missed))
+            items.insert(0, wire_frame(notice, *self.codec()))
+            self.missed = 0
+        if items:
+            self._write(conn, items)
+
+    @classmethod
+    def outbox_stats(cls):
+        return dict(
+            high_water=cls.outbox_high_water,
+            dropped_messages=cls.outbox_dropped,
+            collapsed_messages=cls.outbox_collapsed,
+            disconnected=cls.slow_disconnected,
+        )
+
+    def shutdown(self, frame, payload):
+        """下线前把出队列里的消息和重连通知一起写出, 再以1001关闭"""
+        conn = self.ws_connection
+        if conn is None:
+            return
+        self.replaying = False
+        items = list(self.outbox)
+        self.outbox.clear()
+        items.append((frame, payload))
+        self._write(conn, items)
+        self.close(1001, "server shutting down")
+
+    def on_pong(self, data):
+        self.heartbeat.on_pong(self)
 
     def on_close(self):
-        if not self.client.subscribed:
+        self.heartbeat.remove(self)
+        if self.channels is None:
             return
-        self.client.unsubscribe(self.channels)
-        self.client.disconnect()
+        if self.uid:
+            self.presence.leave(self.channels, self.uid)
+            self.direct.disconnect(self)
+        self.hub.leave(self.channels, self)
 
     def check_origin(self, origin):
         return True
 
 
+class PresenceHandler(RequestHandler):
+    """在线状态查询
+    /pigroom/presence/rooms?ids=1,2     各房间在线人数
+    /pigroom/presence/users?ids=3,4     各用户是否在线
+    /pigroom/presence/members?room=1    房间在线用户列表
+    """
+
+    def initialize(self, presence):
+        self.presence = presence
+
+    def ids(self):
+        ids = [i for i in self.get_argument("ids", "").split(",") if i.isdigit()]
+        return ids[:Presence.MAX_IDS]
+
+    @asynchronous
+    def get(self, kind):
+        if kind == "rooms":
+            ids = self.ids()
+            self.presence.room_counts(["room:" + i for i in ids],
+                                      lambda counts: self.reply(dict(zip(ids, counts))))
+        elif kind == "users":
+            ids = self.ids()
+            self.presence.online(ids, lambda flags: self.reply(
+                dict(zip(ids, flags)) if flags is not None else None))
+        else:
+            room = self.get_argument("room", "")
+            if not room.isdigit():
+                self.send_error(400)
+                return
+            self.presence.room_members("room:" + room, lambda members: self.reply(
+                dict(room=room, members=members) if members is not None else None))
+
+    def reply(self, d):
+        if d is None:
+            # redis不可用
+            self.send_error(503)
+            return
+        self.finish(d)
+
+
+class MetricsHandler(RequestHandler):
+    """节点运行指标, rooms=0时不输出房间明细"""
+
+    def initialize(self, hub, publisher, heartbeat, limiter, presence, watchdog, deflater):
+        self.hub = hub
+        self.publisher = publisher
+        self.heartbeat = heartbeat
+        self.limiter = limiter
+        self.presence = presence
+        self.watchdog = watchdog
+        self.deflater = deflater
+
+    def get(self):
+        hub = self.hub
+        d = dict(
+            node=hub.node_id,
+            hub=hub.stats(),
+            publisher=self.publisher.stats(),
+            outbox=RoomDemo.outbox_stats(),
+            heartbeat=self.heartbeat.stats(),
+            limiter=self.limiter.stats(),
+            presence=self.presence.stats(),
+            direct=hub.direct.stats(),
+            messages=hub.metrics.stats(),
+            stalls=self.watchdog.stats(),
+        )
+        if self.deflater is not None:
+            d["compression"] = self.deflater.stats()
+        if self.get_argument("rooms", "1") != "0":
+            d["rooms"] = hub.metrics.room_stats(hub.rooms)
+        self.write(d)
+
+
 def init_app(cfg):
+    delivery = cfg.get("DELIVERY_BACKEND", PubSubBackend.name)
+    hub = RoomHub()
+    if delivery == MemoryBroker.name:
+        publisher = hub.backend = MemoryBroker(hub, cfg)
+    else:
+        publisher = Publisher(cfg["REDIS_HOST"], cfg["REDIS_PORT"],
+                              cfg.get("PUBLISH_QUEUE_SIZE", 10000),
+                              cfg.get("HISTORY_SIZE", 100),
+                              delivery, cfg.get("STREAM_MAXLEN", 1000))
+        hub.backend = DELIVERY_BACKENDS[delivery](hub, publisher, cfg)
+        if cfg.get("ROOM_REGISTRY_TTL", 60):
+            hub.registry = RoomRegistry(hub, publisher, cfg.get("ROOM_REGISTRY_TTL", 60))
+    hub.publisher = publisher
+    publisher.start()
+    hub.start()
+    heartbeat = HeartbeatWheel(cfg.get("PING_INTERVAL", 30), cfg.get("PONG_TIMEOUT", 10),
+                               cfg.get("IDLE_TIMEOUT", 0))
+    heartbeat.start()
+    limiter = RateLimiter(publisher, cfg)
+    limiter.start()
+    presence = Presence(hub, publisher, cfg.get("PRESENCE_TTL", 90), cfg.get("PRESENCE_FLUSH", 1),
+                        local=delivery == MemoryBroker.name)
+    presence.start()
+    hub.direct = DirectRouter(hub, publisher, presence, delivery,
+                              cfg.get("DIRECT_BACKLOG_SIZE", 100), cfg.get("DIRECT_BACKLOG_TTL", 604800),
+                              cfg.get("STREAM_MAXLEN", 1000), local=delivery == MemoryBroker.name,
+                              require_friends=cfg.get("DIRECT_REQUIRE_FRIENDS", True))
+    watchdog = StallWatchdog(cfg.get("STALL_THRESHOLD", 0), cfg.get("STALL_SAMPLES", 1000))
+    watchdog.start()
+    deflater = None
+    if cfg.get("COMPRESSION"):
+        deflater = Deflater(cfg.get("COMPRESS_LEVEL", 6), cfg.get("COMPRESS_MEM_LEVEL", 8),
+                            cfg.get("COMPRESS_WINDOW_BITS", 15), cfg.get("COMPRESS_MIN_SIZE", 256),
+                            cfg.get("COMPRESS_CLIENT_NO_CONTEXT", False))
     app = Application([
-        (r"/pigroom/ws/(\d+)", RoomDemo, cfg),
-    ])
+        (r"/pigroom/ws/(\d+)", RoomDemo,
+         dict(cfg, hub=hub, publisher=publisher, heartbeat=heartbeat, limiter=limiter,
+              presence=presence, deflater=deflater)),
+        (r"/pigroom/presence/(rooms|users|members)", PresenceHandler, dict(presence=presence)),
+        (r"/pigroom/metrics", MetricsHandler,
+         dict(hub=hub, publisher=publisher, heartbeat=heartbeat, limiter=limiter,
+              presence=presence, watchdog=watchdog, deflater=deflater)),
+    ], hub=hub, publisher=publisher, heartbeat=heartbeat, limiter=limiter,
+       presence=presence, watchdog=watchdog)
     return app
 
 
 def load_from_obj(objname):
-    import config
-    obj = getattr(config, objname)
+    # 配置和Django共用项目根目录下的settings.py
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if root not in sys.path:
+        sys.path.insert(0, root)
+    import settings
+    obj = getattr(settings, objname)
     d = dict()
     for key in dir(obj):
         if key.isupper():
@@ -83,7 +2120,8 @@ def load_from_obj(objname):
 
 
 def load_config():
-    cfg = load_from_obj("DefaultConfig")
+    # 和settings.py一样按PIGROOM_CONF选择配置类
+    cfg = load_from_obj(os.getenv("PIGROOM_CONF", "DefaultConfig"))
     return cfg
 
 
@@ -96,24 +2134,171 @@ def signal_handler(signum, frames):
     IOLoop.current().add_callback_from_signal(stop)
 
 
-def main(debug=False):
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
+class Drainer(object):
+    """平滑下线
+    停止接受新连接, 在DRAIN_WINDOW秒内把现有连接分批通知重连并关闭,
+    等退订和发布队列都写完后再停止IOLoop. 下线过程中再收到信号则立即停止
+    """
+    RECONNECT_MSG = encode_message(dict(type='state', data='reconnect'))
+    GRACE = 5
 
-    cfg = load_config()
+    def __init__(self, server, hub, publisher, presence, window=10, batch_size=100):
+        self.server = server
+        self.hub = hub
+        self.publisher = publisher
+        self.presence = presence
+        self.window = window
+        self.batch_size = max(1, batch_size)
+        self.draining = False
+
+    def install(self):
+        signal.signal(signal.SIGINT, self.on_signal)
+        signal.signal(signal.SIGTERM, self.on_signal)
+
+    def on_signal(self, signum, frames):
+        if self.draining:
+            IOLoop.current().add_callback_from_signal(stop)
+        else:
+            IOLoop.current().add_callback_from_signal(self.drain)
+
+    @engine
+    def drain(self):
+        self.draining = True
+        self.server.stop()
+        handlers = [handler for members in self.hub.rooms.values() for handler in members]
+        log.info("draining %d connections in %ss", len(handlers), self.window)
+        frames = dict()
+        if handlers:
+            batches = (len(handlers) + self.batch_size - 1) // self.batch_size
+            interval = float(self.window) / batches
+            for i in range(0, len(handlers), self.batch_size):
+                for handler in handlers[i:i + self.batch_size]:
+                    codec = handler.codec()
+                    if codec not in frames:
+                        frames[codec] = wire_frame(self.RECONNECT_MSG, *codec)
+                    handler.shutdown(*frames[codec])
+                yield sleep(interval)
+
+        # 等关闭握手完成(连接离开房间时会退订), 再等发布队列写完
+        deadline = time.time() + self.GRACE
+        while self.hub.rooms and time.time() < deadline:
+            yield sleep(0.1)
+        # 离线状态不等定时器, 立即写出
+        self.presence.flush()
+        self.presence.stop()
+        while self.publisher.pending() and time.time() < deadline:
+            yield sleep(0.05)
+        self.hub.stop()
+        self.publisher.stop()
+        stop()
+
+
+def serve(cfg, sockets=None):
+    """在当前进程里运行一个IOLoop, sockets为None时自己绑定端口"""
     host = cfg.get("SERVER_HOST", '0.0.0.0')
     port = cfg.get("SERVER_PORT", 11000)
+    if sockets is None:
+        sockets = bind_sockets(port, address=host,
+                               reuse_port=hasattr(socket, "SO_REUSEPORT"))
 
     app = init_app(cfg)
-    if debug:
-        return app
-
-    print "server listen on %s:%d" % (host, port)
-    app.listen(port, address=host)
+    server = HTTPServer(app)
+    server.add_sockets(sockets)
+    Drainer(server, app.settings["hub"], app.settings["publisher"], app.settings["presence"],
+            cfg.get("DRAIN_WINDOW", 10), cfg.get("DRAIN_BATCH", 100)).install()
 
-    print "server starts..."
+    print "server(%d) starts..." % os.getpid()
     IOLoop.current().start()
 
 
+def supervise(cfg, processes):
+    """预先fork出processes个工作进程
+    支持SO_REUSEPORT时每个子进程各自绑定同一端口, 由内核分配连接,
+    否则在fork前绑定好监听socket由子进程继承. 主进程把SIGTERM/SIGINT转发给子进程,
+    子进程异常退出时重新拉起
+    """
+    host = cfg.get("SERVER_HOST", '0.0.0.0')
+    port = cfg.get("SERVER_PORT", 11000)
+    sockets = None
+    if not hasattr(socket, "SO_REUSEPORT"):
+        sockets = bind_sockets(port, address=host)
+
+    children = dict()
+    stopping = []
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            # 继承来的forward会把信号转发给fork前记下的兄弟进程, 子进程恢复默认处理,
+            # 直到Drainer.install()安装自己的
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            # 每个子进程在fork之后创建自己的IOLoop和redis连接
+            try:
+                serve(cfg, sockets)
+            except Exception:
+                log.exception("worker %d crashed", index)
+                os._exit(1)
+            os._exit(0)
+        children[pid] = (index, time.time())
+
+    def forward(signum, frame):
+        stopping.append(signum)
+        for pid in children:
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGINT, forward)
+    signal.signal(signal.SIGTERM, forward)
+
+    print "server listen on %s:%d with %d processes" % (host, port, processes)
+    for index in range(processes):
+        spawn(index)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        if pid not in children:
+            continue
+        index, started = children.pop(pid)
+        if stopping:
+            continue
+        log.warning("worker %d (pid %d) exited with status %d, respawning",
+                    index, pid, status)
+        if time.time() - started < 1:
+            # 启动即崩溃时不要空转
+            time.sleep(1)
+            if stopping:
+                continue
+        spawn(index)
+    print "server stopped."
+
+
+def main(debug=False):
+    enable_pretty_logging()
+    cfg = load_config()
+
+    if debug:
+        signal.signal(signal.SIGINT, signal_handler)
+        signal.signal(signal.SIGTERM, signal_handler)
+        return init_app(cfg)
+
+    processes = cfg.get("SERVER_PROCESSES", 1)
+    if processes <= 0:
+        processes = cpu_count()
+    if processes == 1:
+        print "server listen on %s:%d" % (cfg.get("SERVER_HOST", '0.0.0.0'),
+                                          cfg.get("SERVER_PORT", 11000))
+        serve(cfg)
+    else:
+        supervise(cfg, processes)
+
+
 if __name__ == "__main__":
     main()
@@ -122,6 +122,47 @@ class DefaultConfig(object):
     REDIS_HOST = 'localhost'
     REDIS_PORT = 6379
     REDIS_DB = 0
+    # webchat
+    SERVER_PROCESSES = 1  # 工作进程数, 0表示每个CPU核一个
+    DRAIN_WINDOW = 10  # 下线时在多少秒内分批关闭现有连接
+    DRAIN_BATCH = 100  # 每批关闭的连接数
+    DELIVERY_BACKEND = 'pubsub'  # 房间消息投递方式: pubsub, stream, memory(单机, 不需要redis)
+    SUBSCRIBER_POOL_SIZE = 1  # pubsub: 每个进程的redis订阅连接数
+    STREAM_MAXLEN = 1000  # stream: 每个房间stream保留的条数(近似)
+    STREAM_BLOCK_MS = 100  # stream: XREAD阻塞时长
+    STREAM_READ_COUNT = 100  # stream: 每个房间每次XREAD最多读取的条数
+    PUBLISH_QUEUE_SIZE = 10000  # 发布队列上限, 超出后丢弃最旧的消息
+    HISTORY_SIZE = 100  # 每个房间保存的聊天记录条数
+    REPLAY_SIZE = 20  # 进入房间时回放的历史条数
+    ROOM_REGISTRY_TTL = 60  # 房间占用表的登记有效期(秒), 只有本节点有人的房间不经过redis投递, 0表示关闭
+    PING_INTERVAL = 30  # 服务端ping间隔(秒)
+    PONG_TIMEOUT = 10  # 发出ping后多少秒没收到pong就断开
+    IDLE_TIMEOUT = 0  # 客户端多少秒没发消息就断开, 0表示不限制
+    PRESENCE_TTL = 90  # 在线状态登记的有效期(秒), 每1/3有效期续期一次
+    PRESENCE_FLUSH = 1  # 在线状态变化合并写入redis的间隔(秒)
+    DIRECT_BACKLOG_SIZE = 100  # 每个用户保留的离线私信条数
+    DIRECT_BACKLOG_TTL = 604800  # 离线私信保留时长(秒)
+    DIRECT_REQUIRE_FRIENDS = True  # 私信只能发给好友, 内存代理无法校验时拒绝私信
+    CHAT_TOKEN_SECRET = SECRET_KEY  # 签发和校验websocket身份令牌的密钥, API和webchat必须相同
+    CHAT_TOKEN_TTL = 86400  # 身份令牌有效期(秒)
+    RATE_CONN_RATE = 5  # 每个连接每秒可发消息数, 0表示不限制
+    RATE_CONN_BURST = 10
+    RATE_ROOM_RATE = 50  # 每个房间集群范围内每秒可发消息数
+    RATE_ROOM_BURST = 100
+    RATE_USER_RATE = 5  # 每个用户集群范围内每秒可发消息数, 只对带有效令牌的连接生效
+    RATE_USER_BURST = 10
+    RATE_WINDOW = 10  # 集群用量统计窗口(秒)
+    OUTBOX_SIZE = 256  # 每个连接待发送消息的上限
+    OUTBOX_POLICY = 'drop_oldest'  # 慢连接策略: drop_oldest, collapse, disconnect
+    OUTBOX_CLOSE_CODE = 1013  # disconnect策略的关闭码, 1008或1013
+    STALL_THRESHOLD = 0  # IOLoop单次回调阻塞超过多少秒时记录堆栈, 0表示关闭
+    STALL_SAMPLES = 1000  # 统计阻塞热点时保留的最近样本数
+    COMPRESSION = False  # 是否支持permessage-deflate压缩
+    COMPRESS_MIN_SIZE = 256  # 小于该字节数的消息不压缩
+    COMPRESS_LEVEL = 6  # zlib压缩级别1-9
+    COMPRESS_MEM_LEVEL = 8  # zlib memLevel 1-9, 越小占内存越少
+    COMPRESS_WINDOW_BITS = 15  # 压缩窗口9-15, 小于15时通过server_max_window_bits告知客户端
+    COMPRESS_CLIENT_NO_CONTEXT = False  # 要求客户端不保留压缩上下文, 省去每个连接常驻的解压窗口
     # email
     EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
     EMAIL_USE_SSL = True
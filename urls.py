@@ -14,7 +14,7 @@ Including another URLconf
 """
 from django.conf.urls import patterns, url, include
 from rest_framework import routers
-from chatroom.views.views import UserViewSet
+from chatroom.views.views import UserViewSet, ChatTokenView
 
 router = routers.DefaultRouter()
 router.register(r'users', UserViewSet)
@@ -23,5 +23,6 @@ router.register(r'users', UserViewSet)
 urlpatterns = [
     # url(r'^', include(router.urls)),
     url(r'^user', UserViewSet.as_view(), name='UserViewSet'),
+    url(r'^chat/token', ChatTokenView.as_view(), name='ChatTokenView'),
     url(r'^api-auth/', include('rest_framework.urls', namespace='rest_framework')),
 ]